@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Tool to benchmark the memory usage and running time of NMF on a corpus, when the document-term matrix and factors
+are stored in double (float64) and single (float32) precision, and for each of the available NMF engines.
+
+Sample usage:
+python benchmark-nmf.py sample.pkl -k 4 -r 5 --maxiters 100
+python benchmark-nmf.py sample.pkl -k 4 -r 5 --maxiters 100 --engines sklearn,hals,mu
+"""
+import random, time, tracemalloc
+import logging as log
+from optparse import OptionParser
+from prettytable import PrettyTable
+import numpy as np
+import scipy.sparse
+import text.util, unsupervised.nmf, unsupervised.util
+
+# --------------------------------------------------------------
+
+def matrix_bytes( X ):
+	"""
+	Return the number of bytes used to store the values of a sparse or dense matrix.
+	"""
+	if scipy.sparse.issparse( X ):
+		return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+	return X.nbytes
+
+def reconstruction_error( X, W, H ):
+	"""
+	Calculate the Frobenius norm of X - WH, without creating the dense product WH.
+	"""
+	if scipy.sparse.issparse( X ):
+		norm_X = np.dot( X.data, X.data )
+	else:
+		norm_X = np.sum( X * X )
+	cross = np.sum( np.asarray( X.dot( H.T ) ) * W )
+	norm_WH = np.sum( W.T.dot( W ) * H.dot( H.T ) )
+	return np.sqrt( max( norm_X - 2 * cross + norm_WH, 0 ) )
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] corpus_file")
+	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
+	parser.add_option("-k", action="store", type="int", dest="k", help="number of topics", default=5)
+	parser.add_option("-r","--runs", action="store", type="int", dest="runs", help="number of runs for each precision", default=3)
+	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=100)
+	parser.add_option("--tol", action="store", type="float", dest="tol", help="tolerance of the NMF stopping condition", default=1e-4)
+	parser.add_option("--dtypes", action="store", type="string", dest="dtypes", help="comma-separated list of precisions to compare (default is float64,float32)", default="float64,float32")
+	parser.add_option("--engines", action="store", type="string", dest="engines", help="comma-separated list of NMF engines to compare (default is sklearn)", default="sklearn")
+	parser.add_option("-o","--output", action="store", type="string", dest="out_path", help="path for CSV output file", default=None)
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if len(args) < 1:
+		parser.error( "Must specify a corpus file" )
+	log_level = max(50 - (options.debug * 10), 10)
+	log.basicConfig(level=log_level, format='%(message)s')
+	dtypes = [ x.strip() for x in options.dtypes.lower().split(",") ]
+	engines = [ x.strip() for x in options.engines.lower().split(",") ]
+	for engine in engines:
+		if not engine in unsupervised.nmf.engine_names:
+			parser.error( "Unknown NMF engine: %s" % engine )
+
+	tab = PrettyTable( ["engine", "dtype", "matrix MB", "factors MB", "peak MB", "secs/run", "iters/run", "error"] )
+	tab.align["engine"] = "l"
+	tab.align["dtype"] = "l"
+	for engine in engines:
+		for dtype in dtypes:
+			# use the same random initializations for each engine and precision
+			np.random.seed( options.seed )
+			random.seed( options.seed )
+			# NB: NumPy reports its array allocations to tracemalloc
+			tracemalloc.start()
+			log.info( "Loading %s corpus from %s ..." % ( dtype, args[0] ) )
+			(X,terms,doc_ids,classes) = text.util.load_corpus( args[0], dtype = dtype )
+			if text.util.is_mmap_corpus( args[0] ):
+				# copy memory-mapped data, so that the matrix is included in the peak memory usage
+				X = X.copy()
+			impl = unsupervised.nmf.create_engine( engine, max_iters = options.maxiter, init_strategy = "random", tol = options.tol )
+			run_times, iters, errors = [], [], []
+			for r in range(options.runs):
+				log.info( "NMF run %d/%d (k=%d, engine=%s, dtype=%s, max_iters=%d)" % ( r+1, options.runs, options.k, engine, dtype, options.maxiter ) )
+				start = time.time()
+				impl.apply( X, options.k )
+				run_times.append( time.time() - start )
+				iters.append( impl.stats["n_iter"] )
+				errors.append( reconstruction_error( X, impl.W, impl.H ) )
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			mb = 1024.0 * 1024
+			tab.add_row( [ engine, dtype, "%.2f" % ( matrix_bytes( X ) / mb ), "%.2f" % ( ( impl.W.nbytes + impl.H.nbytes ) / mb ), "%.2f" % ( peak / mb ),
+				"%.3f" % np.mean( run_times ), "%.1f" % np.mean( iters ), "%.4f" % np.mean( errors ) ] )
+	log.info( tab )
+
+	# Write to CSV?
+	if not options.out_path is None:
+		log.info("Writing benchmark results to %s" % options.out_path)
+		unsupervised.util.write_table( options.out_path, tab )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
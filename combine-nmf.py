@@ -3,7 +3,8 @@
 Tool to combine a collection of base topic models, generated by NMF, to produce a single ensemble topic model.
 
 Sample usage:
-python combine-nmf.py sample.pkl models/base/*factors*.pkl -k 4 -o models/ensemble
+python combine-nmf.py sample.pkl models/base/*factors*.npz -k 4 -o models/ensemble
+python combine-nmf.py sample.pkl models/base/ensemble.ens -k 4 -o models/ensemble
 """
 import os, sys, random, operator
 import logging as log
@@ -16,16 +17,25 @@ import text.util
 # --------------------------------------------------------------
 
 def main():
-	parser = OptionParser(usage="usage: %prog [options] corpus_file base_factors1 base_factors2...")
+	parser = OptionParser(usage="usage: %prog [options] corpus_file base_factors1|archive1 base_factors2|archive2...")
 	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
 	parser.add_option("-k", action="store", type="string", dest="k", help="number of topics", default=10)
 	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=500)
+	parser.add_option("--tol", action="store", type="float", dest="tol", help="tolerance of the NMF stopping condition", default=1e-4)
+	parser.add_option("--engine", action="store", type="choice", choices=unsupervised.nmf.engine_names, dest="engine", help="NMF implementation: sklearn, native hals or mu updates, or online updates over chunks of documents (default is sklearn)", default="sklearn")
+	parser.add_option("--svd-cache", action="store", type="string", dest="svd_cache", help="directory used to cache the truncated SVD of the topic-term matrix, which is reused for the NNDSVD initialization of the ensemble combination", default=None)
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="output directory (default is current directory)", default=None)
 	parser.add_option("-v", "--verbose", action="store_true", dest="verbose", help="display topic descriptors")
+	parser.add_option("--tfidf", action="store_true", dest="apply_tfidf", help="apply TF-IDF term weighting to a corpus of raw term counts (default is the setting used when parsing)", default=None)
+	parser.add_option("--no-tfidf", action="store_false", dest="apply_tfidf", help="do not apply TF-IDF term weighting to a corpus of raw term counts")
+	parser.add_option("--norm", action="store_true", dest="apply_norm", help="apply unit length normalization to a corpus of raw term counts (default is the setting used when parsing)", default=None)
+	parser.add_option("--no-norm", action="store_false", dest="apply_norm", help="do not apply unit length normalization to a corpus of raw term counts")
+	parser.add_option("--dtype", action="store", type="choice", choices=["float64","float32"], dest="dtype", help="precision of the document-term matrix and factors (default is the setting used when parsing)", default=None)
+	parser.add_option("--rank-depth", action="store", type="int", dest="rank_depth", help="number of top terms to store in the ranking for each topic (default is all terms)", default=0)
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
-	if( len(args) < 3 ):
-		parser.error( "Must specify corpus file and at least two base factor files" )
+	if len(args) < 2 or ( len(args) < 3 and not unsupervised.util.is_ensemble_archive( args[-1] ) ):
+		parser.error( "Must specify corpus file and at least two base factor files, or an ensemble archive" )
 	log_level = max(50 - (options.debug * 10), 10)
 	log.basicConfig(level=log_level, format='%(message)s')
 
@@ -49,17 +59,25 @@ def main():
 	
 	# Load the cached corpus
 	log.info( "Loading data from %s ..." % args[0] )
-	(X,all_terms,all_doc_ids,classes) = text.util.load_corpus( args[0] )
+	(X,all_terms,all_doc_ids,classes) = text.util.load_corpus( args[0], options.apply_tfidf, options.apply_norm, options.dtype )
 	log.info( "Read corpus with %d documents, %d terms" % (  len(all_doc_ids), len(all_terms) ) )
 
+	# Collect the base topic models, reading all members of any ensemble archives
+	base_models = []
+	for base_model_path in args[1:]:
+		if unsupervised.util.is_ensemble_archive( base_model_path ):
+			log.info( "Reading base topic models from archive %s ..." % base_model_path )
+			for member in unsupervised.util.EnsembleArchive( base_model_path ).load_members( ["factors"] ):
+				base_models.append( ( "%s:%s" % ( base_model_path, member["name"] ), member["H"] ) )
+		else:
+			(base_H,) = unsupervised.util.load_nmf_fields( base_model_path, ["H"] )
+			base_models.append( ( base_model_path, base_H ) )
+
 	# Process each specified base topic model
-	log.info("Processing %d base topic models ..." % len(args[1:]) )
+	log.info("Processing %d base topic models ..." % len(base_models) )
 	factors = []
-	for base_idx, base_model_path in enumerate(args[1:]):
-		# load the cached base topics
-		base_name = os.path.splitext( os.path.split( base_model_path )[-1] )[0]
-		(base_W,base_H,base_doc_ids,base_terms) = unsupervised.util.load_nmf_factors( base_model_path )
-		base_k = base_W.shape[1]
+	for base_idx, (base_model_path, base_H) in enumerate(base_models):
+		base_k = base_H.shape[0]
 		log.debug("Base model %d: Read %d base topics from %s" % (base_idx + 1, base_k, base_model_path) )
 		# label the topics
 		base_topic_labels = []
@@ -69,23 +87,27 @@ def main():
 		factors.append( base_H )
 
 	# Merge the H factors to create the topic-term matrix
-	M = np.vstack( factors )
+	M = np.vstack( factors ).astype( X.dtype, copy=False )
 	log.info( "Created topic-term matrix of size %dx%d" % M.shape )
 	log.debug( "Matrix statistics: range=[%.2f,%.2f] mean=%.2f" % ( np.min(M), np.max(M), np.mean(M) ) )	
 
 	# NMF implementation
-	impl = unsupervised.nmf.SklNMF( max_iters = options.maxiter, init_strategy = "nndsvd" )
+	impl = unsupervised.nmf.create_engine( options.engine, max_iters = options.maxiter, init_strategy = "nndsvd", tol = options.tol )
 	log.info( "Applying ensemble combination to topic-term matrix for k=%d topics ..." % k )
-	impl.apply( M, k )
+	if options.svd_cache is None:
+		impl.apply( M, k )
+	else:
+		svd_cache = unsupervised.nmf.SVDCache( options.svd_cache )
+		(init_W, init_H) = svd_cache.nndsvd( M, k )
+		impl.apply( M, k, init_W, init_H )
+	log.info( "Stopped after %d iterations (converged=%s), reconstruction error %.4f, %.2f secs" % ( impl.stats["n_iter"], impl.stats["converged"], impl.stats["reconstruction_err"], impl.stats["elapsed"] ) )
+	unsupervised.util.append_run_log( dir_out, "ensemble_k%02d" % k, impl.stats )
 	ensemble_H = np.array( impl.H )
 	ensemble_W = np.array( impl.W )
 	log.debug( "Generated %dx%d factor W and %dx%d factor H" % ( ensemble_W.shape[0], ensemble_W.shape[1], ensemble_H.shape[0], ensemble_H.shape[1] ) )
 	# Create term rankings for each topic
-	term_rankings = []
-	for topic_index in range(k):		
-		ranked_term_indices = impl.rank_terms( topic_index )
-		term_ranking = [all_terms[i] for i in ranked_term_indices]
-		term_rankings.append(term_ranking)
+	ranking_indices = np.array( impl.rank_all_terms( options.rank_depth ), dtype=np.int32 )
+	term_rankings = unsupervised.rankings.index_term_rankings( ranking_indices, all_terms )
 
 	# Print out the top terms?
 	if options.verbose:
@@ -97,7 +119,7 @@ def main():
 	unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
 
 	# Write the complete factorization
-	factor_out_path = os.path.join( dir_out, "factors_ensemble_k%02d.pkl"  % k )
+	factor_out_path = os.path.join( dir_out, "factors_ensemble_k%02d.npz"  % k )
 	log.info( "Writing complete ensemble factorization to %s" % factor_out_path )
 	unsupervised.util.save_nmf_factors( factor_out_path, ensemble_W, ensemble_H, all_doc_ids, all_terms )
 
@@ -109,7 +131,7 @@ def main():
 	doc_partition = np.argmax( D, axis = 1 ).flatten().tolist()	
 
 	# Now write the results
-	doc_factor_out_path = os.path.join( dir_out, "factors_final_k%02d.pkl"  % k )
+	doc_factor_out_path = os.path.join( dir_out, "factors_final_k%02d.npz"  % k )
 	log.info( "Writing ensemble factorization to %s" %  doc_factor_out_path )
 	unsupervised.util.save_nmf_factors( doc_factor_out_path, D, ensemble_H, all_doc_ids, all_terms )
 
@@ -118,6 +140,11 @@ def main():
 	log.info( "Writing ensemble document partition to %s" % doc_partition_out_path )
 	unsupervised.util.save_partition( doc_partition_out_path, doc_partition, all_doc_ids )
 
+	# Record the ensemble model in the manifest for the output directory
+	meta = { "seed" : random_seed, "k" : k, "n_docs" : len(all_doc_ids), "n_base" : len(base_models), "runtime" : impl.stats["elapsed"] }
+	unsupervised.util.append_manifest( dir_out, "ensemble_k%02d" % k, meta, 
+		files = { "ranks" : ranks_out_path, "partition" : doc_partition_out_path, "factors" : doc_factor_out_path } )
+
 # --------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@ Simple tool to display document rankings generated by NMF stored in one or more
 files.
 
 Sample usage:
-python display-top-documents.py base-nmf/factors_1000_001.pkl 
+python display-top-documents.py base-nmf/factors_1000_001.npz 
 """
 import logging as log
 from optparse import OptionParser
@@ -24,7 +24,7 @@ def main():
 	# Load each cached ranking set
 	for in_path in args:
 		log.info( "Loading model from %s ..." % in_path )
-		(W,H,doc_ids,terms) = unsupervised.util.load_nmf_factors( in_path )
+		(W,doc_ids) = unsupervised.util.load_nmf_fields( in_path, ["W","doc_ids"] )
 		k = W.shape[1]
 		log.info( "Model has %d rankings covering %d documents" % ( k, len(doc_ids) ) )
 		for topic_index in range(k):
@@ -5,6 +5,7 @@ resulting from a topic model (i.e. single membership assignments), relative to a
 
 Sample usage:
 python eval-partition-accuracy.py sample.pkl models/base/*partition*.pkl 
+python eval-partition-accuracy.py sample.pkl models/base/ensemble.ens
 """
 import os, os.path, sys
 import logging as log
@@ -29,8 +30,9 @@ def validate( measure, classes, clustering ):
 # --------------------------------------------------------------
 
 def main():
-	parser = OptionParser(usage="usage: %prog [options] corpus_file partition_file1|directory1 ...")
+	parser = OptionParser(usage="usage: %prog [options] corpus_file partition_file1|directory1|archive1 ...")
 	parser.add_option("-s", "--summmary", action="store_true", dest="summary", help="display summary results only")
+	parser.add_option("--select", action="store", type="string", dest="selection", help="only evaluate models whose manifest entries match the given values, e.g. k=10,run=3", default=None)
 	parser.add_option("-o","--output", action="store", type="string", dest="out_path", help="path for CSV output file", default=None)
 	parser.add_option("-m", "--measures", action="store_true", dest="measures", help="comma-separated list of validation measures to use (default is nmi)", default="nmi" )
 	# Parse command line arguments
@@ -41,35 +43,32 @@ def main():
 	measures = [ x.strip() for x in options.measures.lower().split(",") ]
 
 	log.info ("Reading corpus from %s ..." % args[0] )
-	# Load the cached corpus
-	(X,terms,doc_ids,classes) = text.util.load_corpus( args[0] )
-	if classes is None:
+	# Load the document IDs and class indices from the cached corpus
+	(doc_ids,classes_partition) = text.util.load_corpus_fields( args[0], ["doc_ids","labels"] )
+	if classes_partition is None:
 		log.error( "Error: No class information available for this corpus")
 		sys.exit(1)
 
-	# Convert a map to a list of class indices
-	classes_partition = unsupervised.util.clustermap_to_partition( classes, doc_ids )
-
 	# Get list of all specified partition files
-	file_paths = []
-	for path in args[1:]:
-		if not os.path.exists( path ):
-			log.error("No such file or directory: %s" % path )
-			sys.exit(1)
-		if os.path.isdir(path):
-			log.debug("Searching %s for partitions" % path )
-			for dir_path, dirs, files in os.walk(path):
-				for fname in files:
-					if fname.startswith("partition") and fname.endswith(".pkl"):
-						file_paths.append( os.path.join( dir_path, fname ) )
-		else:
-			file_paths.append( path )
-	file_paths.sort()
-
-	if len(file_paths) == 0:
+	if options.selection is None:
+		selection = None
+	else:
+		try:
+			selection = unsupervised.util.parse_selection( options.selection )
+		except ValueError as e:
+			parser.error( str(e) )
+		log.info( "Selecting models with %s" % options.selection )
+	try:
+		(file_paths, archive_members) = unsupervised.util.find_models( args[1:], "partition", selection )
+	except IOError as e:
+		log.error( str(e) )
+		sys.exit(1)
+	archive_paths = list( archive_members.keys() )
+
+	if len(file_paths) == 0 and len(archive_paths) == 0:
 		log.error("No partition files found to validate")
 		sys.exit(1)
-	log.info("Processing partitions for %d base topic models  ..." % len(file_paths) )
+	log.info("Processing partitions for %d base topic model files and %d ensemble archives ..." % ( len(file_paths), len(archive_paths) ) )
 
 	header = ["model"]
 	for measure in measures:
@@ -81,16 +80,24 @@ def main():
 	for measure in measures:
 		scores[measure] = []
 
+	models = []
 	for file_path in file_paths:
 		log.debug( "Loading partition from %s" % file_path )
 		partition,cluster_doc_ids = unsupervised.util.load_partition( file_path )
+		models.append( ( file_path, partition, cluster_doc_ids ) )
+	for archive_path in archive_paths:
+		log.debug( "Loading partitions from archive %s" % archive_path )
+		for member in unsupervised.util.EnsembleArchive( archive_path ).load_members( ["partition"], archive_members[archive_path] ):
+			models.append( ( "%s:%s" % ( archive_path, member["name"] ), member["partition"], member["doc_ids"] ) )
+
+	for (model_name, partition, cluster_doc_ids) in models:
 		k = max(partition) + 1
 		# does the number of documents match up?
 		if len(doc_ids) != len(cluster_doc_ids):
 			log.warning("Error: Cannot compare clusterings on different data")
 			continue
 		# perform validation
-		row = [file_path]
+		row = [model_name]
 		for measure in measures:
 			score = validate(measure,classes_partition,partition)
 			scores[measure].append(score)
@@ -99,7 +106,7 @@ def main():
 			tab.add_row(row)
 
 	# display an overall summary?
-	if options.summary or len(file_paths) > 1:
+	if options.summary or len(models) > 1:
 		# add mean
 		row = ["mean"]
 		for measure in measures:
@@ -4,8 +4,9 @@ Evaluate the stability (i.e. agreement) between a set of partitions generated on
 
 Sample usage:
 python eval-partition-stability.py models/base/*partition*.pkl 
+python eval-partition-stability.py models/base/ensemble.ens
 """
-import os, sys
+import sys
 import logging as log
 from optparse import OptionParser
 import numpy as np
@@ -16,7 +17,8 @@ import unsupervised.nmf, unsupervised.util
 # --------------------------------------------------------------
 
 def main():
-	parser = OptionParser(usage="usage: %prog [options] partition_file1|directory1 ...")
+	parser = OptionParser(usage="usage: %prog [options] partition_file1|directory1|archive1 ...")
+	parser.add_option("--select", action="store", type="string", dest="selection", help="only evaluate models whose manifest entries match the given values, e.g. k=10,run=3", default=None)
 	parser.add_option("-o","--output", action="store", type="string", dest="out_path", help="path for CSV summary file (by default this is not written)", default=None)
 	parser.add_option("--hist", action="store", type="string", dest="hist_out_path", help="path for histogram CSV file (by default this is not written)", default=None)
 	# Parse command line arguments
@@ -26,25 +28,25 @@ def main():
 	log.basicConfig(level=20, format='%(message)s')
 
 	# Get list of all specified partition files
-	file_paths = []
-	for path in args:
-		if not os.path.exists( path ):
-			log.error("No such file or directory: %s" % path )
-			sys.exit(1)
-		if os.path.isdir(path):
-			log.debug("Searching %s for partitions" % path )
-			for dir_path, dirs, files in os.walk(path):
-				for fname in files:
-					if fname.startswith("partition") and fname.endswith(".pkl"):
-						file_paths.append( os.path.join( dir_path, fname ) )
-		else:
-			file_paths.append( path )
-	file_paths.sort()
+	if options.selection is None:
+		selection = None
+	else:
+		try:
+			selection = unsupervised.util.parse_selection( options.selection )
+		except ValueError as e:
+			parser.error( str(e) )
+		log.info( "Selecting models with %s" % options.selection )
+	try:
+		(file_paths, archive_members) = unsupervised.util.find_models( args, "partition", selection )
+	except IOError as e:
+		log.error( str(e) )
+		sys.exit(1)
+	archive_paths = list( archive_members.keys() )
 
-	if len(file_paths) == 0:
+	if len(file_paths) == 0 and len(archive_paths) == 0:
 		log.error("No partition files found to validate")
 		sys.exit(1)
-	log.info("Processing partitions for %d base topic models  ..." % len(file_paths) )
+	log.info("Processing partitions for %d base topic model files and %d ensemble archives ..." % ( len(file_paths), len(archive_paths) ) )
 
 	# Load cached partitions
 	all_partitions = []
@@ -52,6 +54,10 @@ def main():
 		log.debug( "Loading partition from %s" % file_path )
 		partition,cluster_doc_ids = unsupervised.util.load_partition( file_path )
 		all_partitions.append( partition )
+	for archive_path in archive_paths:
+		log.debug( "Loading partitions from archive %s" % archive_path )
+		for member in unsupervised.util.EnsembleArchive( archive_path ).load_members( ["partition"], archive_members[archive_path] ):
+			all_partitions.append( member["partition"] )
 
 	r = len(all_partitions)
 	log.info( "Evaluating stability of %d partitions with NMI ..." % r )
@@ -5,8 +5,9 @@ Evaluate the stability (i.e. agreement) between a set of term rankings generated
 Sample usage:
 python eval-term-stability.py models/base/ranks*.pkl 
 python eval-term-stability.py models/base/
+python eval-term-stability.py models/base/ensemble.ens
 """
-import os, sys
+import sys
 import logging as log
 from optparse import OptionParser
 import numpy as np
@@ -16,8 +17,9 @@ import unsupervised.nmf, unsupervised.rankings, unsupervised.util
 # --------------------------------------------------------------
 
 def main():
-	parser = OptionParser(usage="usage: %prog [options] rank_file1|directory1 ...")
+	parser = OptionParser(usage="usage: %prog [options] rank_file1|directory1|archive1 ...")
 	parser.add_option("-t", "--top", action="store", type="int", dest="top", help="number of top terms to use", default=10)
+	parser.add_option("--select", action="store", type="string", dest="selection", help="only evaluate models whose manifest entries match the given values, e.g. k=10,run=3", default=None)
 	parser.add_option("-o","--output", action="store", type="string", dest="out_path", help="path for CSV output file", default=None)
 	# Parse command line arguments
 	(options, args) = parser.parse_args()
@@ -26,30 +28,41 @@ def main():
 	log.basicConfig(level=20, format='%(message)s')
 
 	# Get list of all specified term ranking files
-	file_paths = []
-	for path in args:
-		if not os.path.exists( path ):
-			log.error("No such file or directory: %s" % path )
-			sys.exit(1)
-		if os.path.isdir(path):
-			log.info("Searching %s for term ranking files" % path )
-			for dir_path, dirs, files in os.walk(path):
-				for fname in files:
-					if fname.startswith("ranks") and fname.endswith(".pkl"):
-						file_paths.append( os.path.join( dir_path, fname ) )
-		else:
-			file_paths.append( path )
-	file_paths.sort()
-	if len(file_paths) == 0:
+	if options.selection is None:
+		selection = None
+	else:
+		try:
+			selection = unsupervised.util.parse_selection( options.selection )
+		except ValueError as e:
+			parser.error( str(e) )
+		log.info( "Selecting models with %s" % options.selection )
+	try:
+		(file_paths, archive_members) = unsupervised.util.find_models( args, "ranks", selection )
+	except IOError as e:
+		log.error( str(e) )
+		sys.exit(1)
+	archive_paths = list( archive_members.keys() )
+	if len(file_paths) == 0 and len(archive_paths) == 0:
 		log.error("No term ranking files found to validate")
 		sys.exit(1)
-	log.info( "Processing %d topic models ..." % len(file_paths) )
+	log.info( "Processing %d topic model files and %d ensemble archives ..." % ( len(file_paths), len(archive_paths) ) )
 
 	# Load cached ranking sets
-	all_term_rankings = []
+	loaded_term_rankings = []
 	for rank_path in file_paths:
 		log.debug( "Loading term ranking set from %s ..." % rank_path )
 		(term_rankings,labels) = unsupervised.util.load_term_rankings( rank_path )
+		loaded_term_rankings.append( term_rankings )
+	for archive_path in archive_paths:
+		log.debug( "Loading term ranking sets from archive %s ..." % archive_path )
+		for member in unsupervised.util.EnsembleArchive( archive_path ).load_members( ["ranks"], archive_members[archive_path] ):
+			loaded_term_rankings.append( member["term_rankings"] )
+	# check that the stored rankings cover enough terms, e.g. if they were generated with --rank-depth
+	depth = min( unsupervised.rankings.term_rankings_size( term_rankings ) for term_rankings in loaded_term_rankings )
+	if depth < options.top:
+		parser.error( "The term rankings only cover the top %d terms, fewer than the top %d terms requested" % ( depth, options.top ) )
+	all_term_rankings = []
+	for term_rankings in loaded_term_rankings:
 		log.debug( "Set has %d rankings covering %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
 		# do we need to truncate the number of terms in the ranking?
 		if options.top > 1:
@@ -4,6 +4,8 @@ Applies a K-Fold strategy with NNDSVD-initialized NMF to the specified dataset t
 
 Sample usage:
 python generate-kfold.py sample.pkl -k 4 -r 5 -f 10 --maxiters 100 -o models/base
+python generate-kfold.py sample.pkl -k 4 -r 5 -f 10 --maxiters 100 -o models/base --archive ensemble.ens
+python generate-kfold.py sample.pkl -k 5:30:5 -r 5 -f 10 --maxiters 100 -o models/base --warm-start
 """
 import os, sys, random
 import logging as log
@@ -19,14 +21,36 @@ def main():
 	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
 	parser.add_option("-r","--runs", action="store", type="int", dest="runs", help="number of runs", default=1)
 	parser.add_option("-f","--folds", action="store", type="int", dest="num_folds", help="number of folds", default=10)
-	parser.add_option("-k", action="store", type="int", dest="k", help="number of topics", default=5)
+	parser.add_option("-k", action="store", type="string", dest="k", help="number of topics, or a range start:end[:step] of numbers of topics", default="5")
+	parser.add_option("--warm-start", action="store_true", dest="warm_start", help="when applying a range of numbers of topics, initialize each fold from the factors of the same fold for the previous number of topics")
 	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=100)
+	parser.add_option("--tol", action="store", type="float", dest="tol", help="tolerance of the NMF stopping condition", default=1e-4)
+	parser.add_option("--engine", action="store", type="choice", choices=unsupervised.nmf.engine_names, dest="engine", help="NMF implementation: sklearn, native hals or mu updates, or online updates over chunks of documents (default is sklearn)", default="sklearn")
+	parser.add_option("--stable-top", action="store", type="int", dest="stable_top", help="stop each run once the specified number of top terms for every topic is stable (by default runs are not stopped early)", default=None)
+	parser.add_option("--patience", action="store", type="int", dest="patience", help="number of consecutive checks for which the top terms must be unchanged, when using --stable-top", default=3)
+	parser.add_option("--check-every", action="store", type="int", dest="check_every", help="number of iterations between checks of the top terms, when using --stable-top", default=5)
+	parser.add_option("--chunk", action="store", type="int", dest="chunk_size", help="number of documents in each chunk processed by the online engine", default=10000)
+	parser.add_option("--svd-cache", action="store", type="string", dest="svd_cache", help="directory used to cache the truncated SVD of the full corpus, which is reused for the NNDSVD initialization of every fold", default=None)
 	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1). default is all", default=1.0)
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
+	parser.add_option("--archive", action="store", type="string", dest="archive_name", help="append the ensemble members to a single archive file in the output directory, rather than writing separate files", default=None)
+	parser.add_option("--factor-top", action="store", type="int", dest="factor_top", help="only store the top weights for each topic in the W and H factors", default=None)
+	parser.add_option("--quantize", action="store_true", dest="quantize", help="store the W and H factors with 16-bit precision")
+	parser.add_option("--compress", action="store_true", dest="compress", help="compress the stored W and H factors")
+	parser.add_option("--tfidf", action="store_true", dest="apply_tfidf", help="apply TF-IDF term weighting to a corpus of raw term counts (default is the setting used when parsing)", default=None)
+	parser.add_option("--no-tfidf", action="store_false", dest="apply_tfidf", help="do not apply TF-IDF term weighting to a corpus of raw term counts")
+	parser.add_option("--norm", action="store_true", dest="apply_norm", help="apply unit length normalization to a corpus of raw term counts (default is the setting used when parsing)", default=None)
+	parser.add_option("--no-norm", action="store_false", dest="apply_norm", help="do not apply unit length normalization to a corpus of raw term counts")
+	parser.add_option("--dtype", action="store", type="choice", choices=["float64","float32"], dest="dtype", help="precision of the document-term matrix and factors (default is the setting used when parsing)", default=None)
+	parser.add_option("--rank-depth", action="store", type="int", dest="rank_depth", help="number of top terms to store in the ranking for each topic (default is all terms)", default=0)
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if len(args) < 1:
 		parser.error( "Must specify at least one corpus file" )	
+	try:
+		ks = unsupervised.util.parse_k_range( options.k )
+	except ValueError as e:
+		parser.error( str(e) )
 	log_level = max(50 - (options.debug * 10), 10)
 	log.basicConfig(level=log_level, format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
 
@@ -47,16 +71,41 @@ def main():
 				
 	# Load the cached corpus
 	corpus_path = args[0]
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path, options.apply_tfidf, options.apply_norm, options.dtype )
 	log.debug( "Read %s document-term matrix, dictionary of %d terms, list of %d document IDs" % ( str(X.shape), len(terms), len(doc_ids) ) )
 	
-	impl = unsupervised.nmf.SklNMF( max_iters = options.maxiter, init_strategy = "nndsvd" )
+	if options.stable_top is None:
+		stability = None
+	else:
+		log.info( "Runs will stop once the top %d terms are unchanged for %d checks, every %d iterations" % ( options.stable_top, options.patience, options.check_every ) )
+		stability = unsupervised.nmf.TermStability( options.stable_top, options.patience, options.check_every )
+	impl = unsupervised.nmf.create_engine( options.engine, max_iters = options.maxiter, init_strategy = "nndsvd", tol = options.tol, chunk_size = options.chunk_size, stability = stability )
+	if options.svd_cache is None:
+		svd_cache = None
+	else:
+		# derive the initialization for each fold from a single SVD of the full corpus
+		svd_cache = unsupervised.nmf.SVDCache( options.svd_cache )
 	n_documents = X.shape[0]
 	n_folds = options.num_folds
 	fold_sizes = (n_documents // n_folds) * np.ones(n_folds, dtype=np.int)
 	fold_sizes[:n_documents % n_folds] += 1
 
 	log.debug( "Results will be written to %s" % dir_out_base )
+	# NB: a separate output directory is used for each number of topics in a range
+	dirs_out, archives = {}, {}
+	for k in ks:
+		if len(ks) == 1:
+			dirs_out[k] = dir_out_base
+		else:
+			dirs_out[k] = os.path.join( dir_out_base, "k%02d" % k )
+			if not os.path.exists( dirs_out[k] ):
+				os.makedirs( dirs_out[k] )
+		if options.archive_name is None:
+			archives[k] = None
+		else:
+			archives[k] = unsupervised.util.EnsembleArchive( os.path.join( dirs_out[k], options.archive_name ) )
+			log.info( "Ensemble members will be appended to archive %s" % archives[k].path )
+	iters_saved, n_members = 0, 0
 	for run in range(options.runs):
 		log.info("Run %d/%d" % ( (run+1), options.runs ) )
 		idxs = np.arange(n_documents)
@@ -78,30 +127,61 @@ def main():
 			log.debug("Creating sparse matrix ...")
 			S = scipy.sparse.csr_matrix(S)
 
-			# apply NMF
-			log.info("Applying NMF (k=%d) to matrix of size %d X %d ..." % ( options.k, S.shape[0], S.shape[1] ) ) 
-			impl.apply( S, options.k )
-			# Get term rankings for each topic
-			term_rankings = []
-			for topic_index in range(options.k):		
-				ranked_term_indices = impl.rank_terms( topic_index )
-				term_ranking = [terms[i] for i in ranked_term_indices]
-				term_rankings.append(term_ranking)
-			log.debug( "Generated ranking set with %d topics covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
-			# Write term rankings
-			ranks_out_path = os.path.join( dir_out_base, "ranks_%s.pkl" % file_suffix )
-			log.debug( "Writing term ranking set to %s" % ranks_out_path )
-			unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
-			# Write document partition
-			partition = impl.generate_partition()
-			partition_out_path = os.path.join( dir_out_base, "partition_%s.pkl" % file_suffix )
-			log.debug( "Writing document partition to %s" % partition_out_path )
-			unsupervised.util.save_partition( partition_out_path, partition, sample_doc_ids )			
-			# Write the complete factorization
-			factor_out_path = os.path.join( dir_out_base, "factors_%s.pkl" % file_suffix )
-			# NB: need to make a copy of the factors
-			log.debug( "Writing factorization for %d documents to %s" % ( len(sample_doc_ids), factor_out_path ) )
-			unsupervised.util.save_nmf_factors( factor_out_path, np.array( impl.W ), np.array( impl.H ), sample_doc_ids, terms )
+			# apply NMF for each number of topics to the same fold
+			previous_factors = None
+			for k in ks:
+				dir_out, archive = dirs_out[k], archives[k]
+				if not previous_factors is None:
+					log.info("Applying NMF (k=%d) to matrix of size %d X %d, starting from the factors for k=%d ..." % ( k, S.shape[0], S.shape[1], previous_factors[1].shape[0] ) ) 
+					(init_W, init_H) = unsupervised.nmf.warm_start_factors( previous_factors[0], previous_factors[1], k )
+					impl.apply( S, k, init_W.astype( S.dtype ), init_H.astype( S.dtype ) )
+				elif svd_cache is None:
+					log.info("Applying NMF (k=%d) to matrix of size %d X %d ..." % ( k, S.shape[0], S.shape[1] ) ) 
+					impl.apply( S, k )
+				else:
+					log.info("Applying NMF (k=%d) to matrix of size %d X %d ..." % ( k, S.shape[0], S.shape[1] ) ) 
+					(init_W, init_H) = svd_cache.nndsvd( X, k, sample_idxs )
+					impl.apply( S, k, init_W, init_H )
+				if options.warm_start:
+					previous_factors = ( impl.W, impl.H )
+				log.debug( "Stopped after %d iterations (converged=%s), reconstruction error %.4f, %.2f secs" % ( impl.stats["n_iter"], impl.stats["converged"], impl.stats["reconstruction_err"], impl.stats["elapsed"] ) )
+				unsupervised.util.append_run_log( dir_out, file_suffix, impl.stats )
+				iters_saved += impl.stats.get( "iters_saved", 0 )
+				meta = { "seed" : options.seed, "run" : run+1, "fold" : fold+1, "k" : k, "n_docs" : len(sample_doc_ids), "runtime" : impl.stats["elapsed"] }
+				# Get term rankings for each topic
+				ranking_indices = np.array( impl.rank_all_terms( options.rank_depth ), dtype=np.int32 )
+				term_rankings = unsupervised.rankings.index_term_rankings( ranking_indices, terms )
+				log.debug( "Generated ranking set with %d topics covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
+				partition = impl.generate_partition()
+				n_members += 1
+				# Append to the ensemble archive, rather than writing separate files?
+				if not archive is None:
+					log.debug( "Appending ensemble member %s to %s" % ( file_suffix, archive.path ) )
+					checksum = archive.append( file_suffix, np.array( impl.W ), np.array( impl.H ), sample_doc_ids, terms, partition, term_rankings,
+						meta = meta, top = options.factor_top, quantize = options.quantize, compress = options.compress )
+					unsupervised.util.append_manifest( dir_out, file_suffix, meta, archive_path = archive.path, checksum = checksum )
+					continue
+				# Write term rankings
+				ranks_out_path = os.path.join( dir_out, "ranks_%s.pkl" % file_suffix )
+				log.debug( "Writing term ranking set to %s" % ranks_out_path )
+				unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
+				# Write document partition
+				partition_out_path = os.path.join( dir_out, "partition_%s.pkl" % file_suffix )
+				log.debug( "Writing document partition to %s" % partition_out_path )
+				unsupervised.util.save_partition( partition_out_path, partition, sample_doc_ids )			
+				# Write the complete factorization
+				factor_out_path = os.path.join( dir_out, "factors_%s.npz" % file_suffix )
+				# NB: need to make a copy of the factors
+				log.debug( "Writing factorization for %d documents to %s" % ( len(sample_doc_ids), factor_out_path ) )
+				unsupervised.util.save_nmf_factors( factor_out_path, np.array( impl.W ), np.array( impl.H ), sample_doc_ids, terms,
+					top = options.factor_top, quantize = options.quantize, compress = options.compress )
+				# Record the model in the manifest for the output directory
+				unsupervised.util.append_manifest( dir_out, file_suffix, meta, 
+					files = { "ranks" : ranks_out_path, "partition" : partition_out_path, "factors" : factor_out_path } )
+	if not stability is None:
+		log.info( "Stopping on stable top terms saved an estimated %d iterations over %d runs, compared with stopping by tolerance" % ( iters_saved, n_members ) )
+	if not svd_cache is None:
+		log.info( "SVD cache: %d SVDs reused, %d calculated" % ( svd_cache.hits, svd_cache.misses ) )
 
 # --------------------------------------------------------------
 
@@ -4,6 +4,10 @@ Applies randomly-initialized NMF to the specified dataset to generate an ensembl
 
 Sample usage:
 python generate-nmf.py sample.pkl -k 4 -r 20 --maxiters 100 -o models/base
+python generate-nmf.py sample.pkl -k 4 -r 20 --maxiters 100 -o models/base --archive ensemble.ens
+python generate-nmf.py sample.pkl -k 4 -r 20 --maxiters 100 -o models/base --engine hals --batch 10
+python generate-nmf.py sample.pkl -k 5:30:5 -r 20 --maxiters 100 -o models/base --warm-start
+python generate-nmf.py sample.corpus -k 4 -r 20 --maxiters 100 -o models/base --engine online --chunk 50000
 """
 import os, sys, random
 import logging as log
@@ -14,19 +18,54 @@ import text.util, unsupervised.nmf, unsupervised.rankings, unsupervised.util
 
 # --------------------------------------------------------------
 
+def warm_start( factors, k, dtype ):
+	"""
+	Create the initial factors for k topics from the factors of a previous run, in the specified precision.
+	"""
+	(W, H) = unsupervised.nmf.warm_start_factors( factors[0], factors[1], k )
+	return ( W.astype( dtype ), H.astype( dtype ) )
+
 def main():
 	parser = OptionParser(usage="usage: %prog [options] dataset_file")
 	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
-	parser.add_option("-k", action="store", type="int", dest="k", help="number of topics", default=5)
+	parser.add_option("-k", action="store", type="string", dest="k", help="number of topics, or a range start:end[:step] of numbers of topics", default="5")
+	parser.add_option("--warm-start", action="store_true", dest="warm_start", help="when applying a range of numbers of topics, initialize each run from the factors of the same run for the previous number of topics")
 	parser.add_option("-r","--runs", action="store", type="int", dest="runs", help="number of runs", default=1)
 	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=100)
+	parser.add_option("--tol", action="store", type="float", dest="tol", help="tolerance of the NMF stopping condition", default=1e-4)
+	parser.add_option("--engine", action="store", type="choice", choices=unsupervised.nmf.engine_names, dest="engine", help="NMF implementation: sklearn, native hals or mu updates, or online updates over chunks of documents (default is sklearn)", default="sklearn")
+	parser.add_option("--stable-top", action="store", type="int", dest="stable_top", help="stop each run once the specified number of top terms for every topic is stable (by default runs are not stopped early)", default=None)
+	parser.add_option("--patience", action="store", type="int", dest="patience", help="number of consecutive checks for which the top terms must be unchanged, when using --stable-top", default=3)
+	parser.add_option("--check-every", action="store", type="int", dest="check_every", help="number of iterations between checks of the top terms, when using --stable-top", default=5)
+	parser.add_option("--chunk", action="store", type="int", dest="chunk_size", help="number of documents in each chunk processed by the online engine", default=10000)
+	parser.add_option("--batch", action="store", type="int", dest="batch_size", help="number of runs to apply together, sharing each pass over the matrix (hals or mu engines only)", default=1)
 	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1). default is all", default=1.0)
 	parser.add_option("--nndsvd", action="store_true", dest="use_nndsvd", help="use nndsvd initialization instead of random")
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
+	parser.add_option("--archive", action="store", type="string", dest="archive_name", help="append the ensemble members to a single archive file in the output directory, rather than writing separate files", default=None)
+	parser.add_option("--factor-top", action="store", type="int", dest="factor_top", help="only store the top weights for each topic in the W and H factors", default=None)
+	parser.add_option("--quantize", action="store_true", dest="quantize", help="store the W and H factors with 16-bit precision")
+	parser.add_option("--compress", action="store_true", dest="compress", help="compress the stored W and H factors")
+	parser.add_option("--tfidf", action="store_true", dest="apply_tfidf", help="apply TF-IDF term weighting to a corpus of raw term counts (default is the setting used when parsing)", default=None)
+	parser.add_option("--no-tfidf", action="store_false", dest="apply_tfidf", help="do not apply TF-IDF term weighting to a corpus of raw term counts")
+	parser.add_option("--norm", action="store_true", dest="apply_norm", help="apply unit length normalization to a corpus of raw term counts (default is the setting used when parsing)", default=None)
+	parser.add_option("--no-norm", action="store_false", dest="apply_norm", help="do not apply unit length normalization to a corpus of raw term counts")
+	parser.add_option("--dtype", action="store", type="choice", choices=["float64","float32"], dest="dtype", help="precision of the document-term matrix and factors (default is the setting used when parsing)", default=None)
+	parser.add_option("--rank-depth", action="store", type="int", dest="rank_depth", help="number of top terms to store in the ranking for each topic (default is all terms)", default=0)
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if len(args) < 1:
 		parser.error( "Must specify at least one corpus file" )	
+	if options.batch_size > 1 and not options.engine in ["hals", "mu"]:
+		parser.error( "Batched runs are not supported by the %s engine" % options.engine )
+	if options.batch_size > 1 and options.sample_ratio < 1:
+		parser.error( "Batched runs cannot be used with document sampling" )
+	if options.warm_start and options.sample_ratio < 1:
+		parser.error( "Warm starts cannot be used with document sampling" )
+	try:
+		ks = unsupervised.util.parse_k_range( options.k )
+	except ValueError as e:
+		parser.error( str(e) )
 	log_level = max(50 - (options.debug * 10), 10)
 	log.basicConfig(level=log_level, format='%(message)s')
 
@@ -47,7 +86,7 @@ def main():
 				
 	# Load the cached corpus
 	corpus_path = args[0]
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path, options.apply_tfidf, options.apply_norm, options.dtype )
 	log.debug( "Read %s document-term matrix, dictionary of %d terms, list of %d document IDs" % ( str(X.shape), len(terms), len(doc_ids) ) )
 	
 	# Choose implementation
@@ -55,61 +94,116 @@ def main():
 		init_strategy = "nndsvd"
 	else:
 		init_strategy = "random"
-	impl = unsupervised.nmf.SklNMF( max_iters = options.maxiter, init_strategy = init_strategy )
+	if options.stable_top is None:
+		stability = None
+	else:
+		log.info( "Runs will stop once the top %d terms are unchanged for %d checks, every %d iterations" % ( options.stable_top, options.patience, options.check_every ) )
+		stability = unsupervised.nmf.TermStability( options.stable_top, options.patience, options.check_every )
+	impl = unsupervised.nmf.create_engine( options.engine, max_iters = options.maxiter, init_strategy = init_strategy, tol = options.tol, chunk_size = options.chunk_size, stability = stability )
 
 	n_documents = X.shape[0]
 	n_sample = int( options.sample_ratio * n_documents )
 	indices = np.arange(n_documents)
 
-	log.info( "Applying NMF (k=%d, runs=%d, seed=%s, init_strategy=%s) ..." % ( options.k, options.runs, options.seed, init_strategy ) )
+	log.info( "Applying NMF (k=%s, runs=%d, seed=%s, init_strategy=%s, engine=%s) ..." % ( options.k, options.runs, options.seed, init_strategy, options.engine ) )
 	if options.sample_ratio < 1:
 		log.info( "Sampling ratio = %.2f - %d/%d documents per run" % ( options.sample_ratio, n_sample, n_documents ) )
 	log.debug( "Results will be written to %s" % dir_out_base )
-	# Run NMF
-	for r in range(options.runs):
-		log.info( "NMF run %d/%d (k=%d, max_iters=%d)" % (r+1, options.runs, options.k, options.maxiter ) )
-		file_suffix = "%s_%03d" % ( options.seed, r+1 )
-		# randomly sub-sample the data
-		if options.sample_ratio < 1:
-			log.info("Subsamping the data ...")
-			np.random.shuffle(indices)
-			sample_indices = indices[0:n_sample]
-			S = X[sample_indices,:]
-			log.info("Creating sparse matrix ...")
-			S = scipy.sparse.csr_matrix(S)
-			sample_doc_ids = []
-			for doc_index in sample_indices:
-				sample_doc_ids.append( doc_ids[doc_index] )
+	# Run NMF for each number of topics, using the same loaded corpus
+	iters_saved, n_members = 0, 0
+	previous_factors = {}
+	for k in ks:
+		# NB: a separate output directory is used for each number of topics in a range
+		if len(ks) == 1:
+			dir_out = dir_out_base
+		else:
+			dir_out = os.path.join( dir_out_base, "k%02d" % k )
+			if not os.path.exists( dir_out ):
+				os.makedirs( dir_out )
+			log.info( "Applying NMF for k=%d, writing results to %s" % ( k, dir_out ) )
+		if options.archive_name is None:
+			archive = None
 		else:
-			S = X
-			sample_doc_ids = doc_ids
-		# apply NMF
-		log.info("Applying NMF to matrix of size %d X %d ..." % ( S.shape[0], S.shape[1] ) ) 
-		impl.apply( S, options.k )
-		log.debug("Generated factors: W %s, H %s" % ( impl.W.shape, impl.H.shape ) )
-		# Get term rankings for each topic
-		term_rankings = []
-		for topic_index in range(options.k):		
-			ranked_term_indices = impl.rank_terms( topic_index )
-			term_ranking = [terms[i] for i in ranked_term_indices]
-			term_rankings.append(term_ranking)
-		log.debug( "Generated ranking set with %d topics covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
-		# Write term rankings
-		ranks_out_path = os.path.join( dir_out_base, "ranks_%s.pkl" % file_suffix )
-		log.debug( "Writing term ranking set to %s" % ranks_out_path )
-		unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
-		# Write document partition
-		partition = impl.generate_partition()
-		partition_out_path = os.path.join( dir_out_base, "partition_%s.pkl" % file_suffix )
-		log.debug( "Writing document partition to %s" % partition_out_path )
-		unsupervised.util.save_partition( partition_out_path, partition, sample_doc_ids )			
-		# Write the complete factorization
-		factor_out_path = os.path.join( dir_out_base, "factors_%s.pkl" % file_suffix )
-		# NB: need to make a copy of the factors
-		log.debug( "Writing factorization for %d documents to %s" % ( len(sample_doc_ids), factor_out_path ) )
-		unsupervised.util.save_nmf_factors( factor_out_path, np.array( impl.W ), np.array( impl.H ), sample_doc_ids, terms )
+			archive = unsupervised.util.EnsembleArchive( os.path.join( dir_out, options.archive_name ) )
+			log.info( "Ensemble members will be appended to archive %s" % archive.path )
+		next_factors = {}
+		for r in range(options.runs):
+			log.info( "NMF run %d/%d (k=%d, max_iters=%d)" % (r+1, options.runs, k, options.maxiter ) )
+			file_suffix = "%s_%03d" % ( options.seed, r+1 )
+			# randomly sub-sample the data
+			if options.sample_ratio < 1:
+				log.info("Subsamping the data ...")
+				np.random.shuffle(indices)
+				sample_indices = indices[0:n_sample]
+				S = X[sample_indices,:]
+				log.info("Creating sparse matrix ...")
+				S = scipy.sparse.csr_matrix(S)
+				sample_doc_ids = []
+				for doc_index in sample_indices:
+					sample_doc_ids.append( doc_ids[doc_index] )
+			else:
+				S = X
+				sample_doc_ids = doc_ids
+			# apply NMF
+			if options.batch_size > 1:
+				# apply NMF for the next batch of runs together, then select the results for this run
+				if r % options.batch_size == 0:
+					n_batch = min( options.batch_size, options.runs - r )
+					log.info("Applying NMF to matrix of size %d X %d for %d runs ..." % ( S.shape[0], S.shape[1], n_batch ) ) 
+					if len(previous_factors) > 0:
+						impl.apply_batch( S, k, n_batch, inits = [warm_start( previous_factors[r+b], k, S.dtype ) for b in range(n_batch)] )
+					else:
+						impl.apply_batch( S, k, n_batch )
+				impl.select( r % options.batch_size )
+			elif len(previous_factors) > 0:
+				log.info("Applying NMF to matrix of size %d X %d, starting from the factors for k=%d ..." % ( S.shape[0], S.shape[1], previous_factors[r][1].shape[0] ) ) 
+				(init_W, init_H) = warm_start( previous_factors[r], k, S.dtype )
+				impl.apply( S, k, init_W, init_H )
+			else:
+				log.info("Applying NMF to matrix of size %d X %d ..." % ( S.shape[0], S.shape[1] ) ) 
+				impl.apply( S, k )
+			if options.warm_start:
+				next_factors[r] = ( impl.W, impl.H )
+			log.debug( "Stopped after %d iterations (converged=%s), reconstruction error %.4f, %.2f secs" % ( impl.stats["n_iter"], impl.stats["converged"], impl.stats["reconstruction_err"], impl.stats["elapsed"] ) )
+			unsupervised.util.append_run_log( dir_out, file_suffix, impl.stats )
+			iters_saved += impl.stats.get( "iters_saved", 0 )
+			meta = { "seed" : options.seed, "run" : r+1, "k" : k, "n_docs" : len(sample_doc_ids), "runtime" : impl.stats["elapsed"] }
+			log.debug("Generated factors: W %s, H %s" % ( impl.W.shape, impl.H.shape ) )
+			# Get term rankings for each topic
+			ranking_indices = np.array( impl.rank_all_terms( options.rank_depth ), dtype=np.int32 )
+			term_rankings = unsupervised.rankings.index_term_rankings( ranking_indices, terms )
+			log.debug( "Generated ranking set with %d topics covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
+			partition = impl.generate_partition()
+			n_members += 1
+			# Append to the ensemble archive, rather than writing separate files?
+			if not archive is None:
+				log.debug( "Appending ensemble member %s to %s" % ( file_suffix, archive.path ) )
+				checksum = archive.append( file_suffix, np.array( impl.W ), np.array( impl.H ), sample_doc_ids, terms, partition, term_rankings,
+					meta = meta, top = options.factor_top, quantize = options.quantize, compress = options.compress )
+				unsupervised.util.append_manifest( dir_out, file_suffix, meta, archive_path = archive.path, checksum = checksum )
+				continue
+			# Write term rankings
+			ranks_out_path = os.path.join( dir_out, "ranks_%s.pkl" % file_suffix )
+			log.debug( "Writing term ranking set to %s" % ranks_out_path )
+			unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
+			# Write document partition
+			partition_out_path = os.path.join( dir_out, "partition_%s.pkl" % file_suffix )
+			log.debug( "Writing document partition to %s" % partition_out_path )
+			unsupervised.util.save_partition( partition_out_path, partition, sample_doc_ids )			
+			# Write the complete factorization
+			factor_out_path = os.path.join( dir_out, "factors_%s.npz" % file_suffix )
+			# NB: need to make a copy of the factors
+			log.debug( "Writing factorization for %d documents to %s" % ( len(sample_doc_ids), factor_out_path ) )
+			unsupervised.util.save_nmf_factors( factor_out_path, np.array( impl.W ), np.array( impl.H ), sample_doc_ids, terms,
+				top = options.factor_top, quantize = options.quantize, compress = options.compress )
+			# Record the model in the manifest for the output directory
+			unsupervised.util.append_manifest( dir_out, file_suffix, meta, 
+				files = { "ranks" : ranks_out_path, "partition" : partition_out_path, "factors" : factor_out_path } )
+		previous_factors = next_factors
 
-	log.info("Generated %d ensemble members" % (r+1))
+	log.info("Generated %d ensemble members" % n_members)
+	if not stability is None:
+		log.info( "Stopping on stable top terms saved an estimated %d iterations over %d runs, compared with stopping by tolerance" % ( iters_saved, n_members ) )
 
 # --------------------------------------------------------------
 
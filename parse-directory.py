@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 """
-Tool to parse a collection of documents, where each file is stored in a separate plain text file.
+Tool to parse a collection of documents, where each file is stored in a separate plain text file. The files can
+be stored in directories, or in zip or tar archives which are read without extracting them.
 
 Sample usage:
 python parse-directory.py data/sample-text/ -o sample --tfidf --norm
+python parse-directory.py data/new-text/ -a sample.pkl
+python parse-directory.py data/sample-text.zip -o sample --tfidf --norm
 """
 import os, os.path, sys, codecs, re, unicodedata
 import logging as log
@@ -12,86 +15,197 @@ import text.util
 
 # --------------------------------------------------------------
 
+def get_document_id( filepath ):
+	"""
+	Create the class label and document ID for the specified file, based on its directory and filename.
+	"""
+	label = os.path.basename( os.path.dirname( filepath ).replace(" ", "_") )
+	doc_id = os.path.splitext( os.path.basename( filepath ) )[0]
+	if not doc_id.startswith(label):
+		doc_id = "%s_%s" % ( label, doc_id )
+	return (label, doc_id)
+
+def sort_documents( X, doc_ids, doc_order ):
+	"""
+	Reorder the rows of the document-term matrix, so that documents read from archives appear in the same order as they 
+	would if the archives had been extracted to directories.
+	"""
+	order = sorted( range(len(doc_order)), key = lambda i: doc_order[i] )
+	if order == list(range(len(order))):
+		return (X, doc_ids)
+	return ( X[order,:], [doc_ids[i] for i in order] )
+
 def main():
-	parser = OptionParser(usage="usage: %prog [options] dir1 dir2 ...")
+	parser = OptionParser(usage="usage: %prog [options] dir1|archive1 dir2|archive2 ...")
 	parser.add_option("-o", action="store", type="string", dest="prefix", help="output prefix for corpus files", default=None)
 	parser.add_option("--df", action="store", type="int", dest="min_df", help="minimum number of documents for a term to appear", default=20)
+	parser.add_option("--maxdf", action="store", type="float", dest="max_df", help="maximum proportion of documents (or number of documents, if > 1) in which a term can appear", default=1.0)
+	parser.add_option("--maxterms", action="store", type="int", dest="max_features", help="maximum number of terms, keeping those with the highest document frequencies", default=None)
+	parser.add_option("--budget", action="store", type="float", dest="max_memory", help="maximum size of the document-term matrix in MB, keeping the terms with the highest document frequencies", default=None)
 	parser.add_option("--tfidf", action="store_true", dest="apply_tfidf", help="apply TF-IDF term weight to the document-term matrix")
 	parser.add_option("--norm", action="store_true", dest="apply_norm", help="apply unit length normalization to the document-term matrix")
 	parser.add_option("--minlen", action="store", type="int", dest="min_doc_length", help="minimum document length (in characters)", default=50)
 	parser.add_option("-s", action="store", type="string", dest="stoplist_file", help="custom stopword file path", default=None)
+	parser.add_option("--lemmatize", action="store_true", dest="lemmatize", help="apply WordNet lemmatization to the tokens")
+	parser.add_option("--lemma-memo", action="store", type="string", dest="memo_path", help="file used to persist lemmatization results between runs", default=None)
+	parser.add_option("-a", "--append", action="store", type="string", dest="append_path", help="existing corpus file to which new documents are appended, using its vocabulary and term weights", default=None)
+	parser.add_option("--cache", action="store", type="string", dest="cache_path", help="token cache file, so that only new or changed documents are tokenized", default=None)
+	parser.add_option("--dtype", action="store", type="choice", choices=["float64","float32"], dest="dtype", help="precision of the weighted document-term matrix (float64 or float32)", default="float64")
+	parser.add_option("--mmap", action="store_true", dest="mmap", help="store the corpus as a directory of arrays which can be memory-mapped when loaded")
+	parser.add_option("--chunk", action="store", type="int", dest="chunk_size", help="number of documents to vectorize at a time", default=10000)
+	parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="number of worker processes used to read and tokenize documents (0 uses all cores)", default=1)
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 1 ):
 		parser.error( "Must specify at least one directory" )	
 	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(message)s')
+	if options.max_df > 1:
+		options.max_df = int(options.max_df)
 	
-	# Find all relevant files in directories specified by user
+	# Find all relevant files in directories specified by user. Each source is either a list of files, or an archive
+	sources = []
 	filepaths = []
+	archive_count = 0
 	args.sort()
 	for in_path in args:
 		if os.path.isdir( in_path ):
 			log.info( "Searching %s for documents ..." % in_path )
-			for fpath in text.util.find_documents( in_path ):
-				filepaths.append( fpath )
+			sources.append( text.util.find_documents( in_path ) )
+			filepaths += sources[-1]
+		elif text.util.is_archive( in_path ):
+			sources.append( in_path )
+			archive_count += 1
 		else:
 			if in_path.startswith(".") or in_path.startswith("_"):
 				continue
+			sources.append( [in_path] )
 			filepaths.append( in_path )
 	log.info( "Found %d documents to parse" % len(filepaths) )
+	if archive_count > 0:
+		log.info( "Found %d archives to parse" % archive_count )
+
+	# Fold new documents into an existing corpus?
+	if not options.append_path is None:
+		log.info( "Loading existing corpus from %s ..." % options.append_path )
+		(X_base,terms,base_doc_ids,base_classes,info) = text.util.load_corpus_info( options.append_path )
+		if info is None:
+			log.error( "Error: Corpus %s has no pre-processing information stored, so new documents cannot be folded in" % options.append_path )
+			sys.exit(1)
+		log.info( "Read corpus with %d documents, %d terms. Ignoring pre-processing options in favour of those stored with the corpus" % ( len(base_doc_ids), len(terms) ) )
+		params = info["params"]
+		existing_doc_ids = set( base_doc_ids )
+		include = lambda filepath: get_document_id( filepath )[1] not in existing_doc_ids
+		new_filepaths = [filepath for filepath in filepaths if include( filepath )]
+		log.info( "Skipping %d documents already in the corpus" % ( len(filepaths) - len(new_filepaths) ) )
+		for i, source in enumerate(sources):
+			if isinstance( source, list ):
+				sources[i] = [filepath for filepath in source if include( filepath )]
+	else:
+		# Load the stopwords used to filter the documents
+		if options.stoplist_file is None:
+			stopwords = text.util.load_stopwords("text/stopwords.txt")
+		elif options.stoplist_file.lower() == "none":
+			log.info("Using no stopwords")
+			stopwords = set()
+		else:
+			log.info( "Using custom stopwords from %s" % options.stoplist_file )
+			stopwords = text.util.load_stopwords(options.stoplist_file)
+		params = text.util.build_params( text.util.DefaultTokenizer( lemmatize = options.lemmatize ), stopwords, min_df = options.min_df, apply_tfidf = options.apply_tfidf, apply_norm = options.apply_norm, 
+			max_df = options.max_df, max_features = options.max_features, max_memory = options.max_memory, dtype = options.dtype )
+
+	# Reuse lemmatization results from previous runs?
+	tokenizer = params["tokenizer"]
+	memo = getattr( tokenizer, "memo", None )
+	if not ( memo is None or options.memo_path is None ) and os.path.exists( options.memo_path ):
+		memo.load( options.memo_path )
+		log.info( "Loaded %d lemmatized terms from %s" % ( len(memo), options.memo_path ) )
+
+	if options.append_path is None:
+		include = None
 
-	# Read the documents
-	log.info( "Reading documents ..." )
-	docs = []
+	# Use cached term counts for documents which have not changed?
+	if options.cache_path is None:
+		cache = None
+	else:
+		log.info( "Using token cache %s" % options.cache_path )
+		cache = text.util.TokenCache( options.cache_path, params )
+
+	# Read and tokenize the documents, which are passed to the pre-processing step as they are read
 	short_documents = 0
 	doc_ids = []
+	doc_order = []
 	label_count = {}
 	classes = {}
-	for filepath in filepaths:
-		# create the document ID
-		label = os.path.basename( os.path.dirname( filepath ).replace(" ", "_") )
-		doc_id = os.path.splitext( os.path.basename( filepath ) )[0]
-		if not doc_id.startswith(label):
-			doc_id = "%s_%s" % ( label, doc_id )
-		# read body text
-		log.debug( "Reading text from %s ..." % filepath )
-		body = text.util.read_text( filepath )
-		if len(body) < options.min_doc_length:
-			short_documents += 1
-			continue
-		docs.append(body)	
-		doc_ids.append(doc_id)	
-		if label not in classes:
-			classes[label] = set()
-			label_count[label] = 0
-		classes[label].add(doc_id)
-		label_count[label] += 1
-	log.info( "Kept %d documents. Skipped %d documents with length < %d" % ( len(docs), short_documents, options.min_doc_length ) )
-	if len(classes) < 2:
-		log.warning( "No ground truth available" )
-		classes = None
-	else:
-		log.info( "Ground truth: %d classes - %s" % ( len(classes), label_count ) )
+	def read_sources():
+		for source_index, source in enumerate(sources):
+			if not isinstance( source, list ):
+				log.info( "Reading documents from archive %s ..." % source )
+				for (filepath, length, counts) in text.util.read_archive_term_counts( source, params, cache, options.jobs, include ):
+					yield ( source_index, filepath, length, counts )
+			else:
+				for filepath, (length, counts) in zip( source, text.util.read_term_counts( source, params, cache, options.jobs ) ):
+					yield ( source_index, filepath, length, counts )
+	def generate_term_counts():
+		nonlocal short_documents
+		for (source_index, filepath, length, counts) in read_sources():
+			(label, doc_id) = get_document_id( filepath )
+			log.debug( "Read text from %s" % filepath )
+			if length < options.min_doc_length:
+				short_documents += 1
+				continue
+			doc_ids.append(doc_id)	
+			doc_order.append( (source_index, filepath) )
+			if label not in classes:
+				classes[label] = set()
+				label_count[label] = 0
+			classes[label].add(doc_id)
+			label_count[label] += 1
+			yield counts
 
-	# Convert the documents in TF-IDF vectors and filter stopwords
-	if options.stoplist_file is None:
-		stopwords = text.util.load_stopwords("text/stopwords.txt")
-	elif options.stoplist_file.lower() == "none":
-		log.info("Using no stopwords")
-		stopwords = set()
+	if options.jobs != 1:
+		log.info( "Reading and tokenizing documents with %s worker processes" % ( options.jobs if options.jobs > 0 else "all available" ) )
+	if not options.append_path is None:
+		# Convert the new documents to vectors using the existing vocabulary
+		log.info( "Reading and folding in new documents ..." )
+		X = text.util.fold_in_term_counts( generate_term_counts(), terms, info, chunk_size = options.chunk_size )
+		(X,doc_ids) = sort_documents( X, doc_ids, doc_order )
+		log.info( "Kept %d new documents. Skipped %d documents with length < %d" % ( len(doc_ids), short_documents, options.min_doc_length ) )
+		if base_classes is None:
+			classes = None
+		(X,doc_ids,classes) = text.util.append_corpus( X_base, base_doc_ids, base_classes, X, doc_ids, classes )
 	else:
-		log.info( "Using custom stopwords from %s" % options.stoplist_file )
-		stopwords = text.util.load_stopwords(options.stoplist_file)
-	log.info( "Pre-processing data (%d stopwords, tfidf=%s, normalize=%s, min_df=%d) ..." % (len(stopwords), options.apply_tfidf, options.apply_norm, options.min_df) )
-	(X,terms) = text.util.preprocess( docs, stopwords, min_df = options.min_df, apply_tfidf = options.apply_tfidf, apply_norm = options.apply_norm )
+		# Convert the documents in TF-IDF vectors and filter stopwords
+		log.info( "Reading and pre-processing documents (%d stopwords, tfidf=%s, normalize=%s, min_df=%d) ..." % (len(stopwords), options.apply_tfidf, options.apply_norm, options.min_df) )
+		(X,terms,info) = text.util.preprocess_term_counts( generate_term_counts(), params, chunk_size = options.chunk_size, return_info = True, return_counts = True )
+		(X,doc_ids) = sort_documents( X, doc_ids, doc_order )
+		log.info( "Storing raw term counts, term weighting will be applied when the corpus is loaded" )
+		log.info( "Pruned vocabulary from %d to %d terms (%.1f%%), non-zero entries from %d to %d (%.1f%%)" % ( info["unpruned_terms"], X.shape[1], 
+			100.0 * X.shape[1] / max( info["unpruned_terms"], 1 ), info["unpruned_nnz"], X.nnz, 100.0 * X.nnz / max( info["unpruned_nnz"], 1 ) ) )
+		log.info( "Kept %d documents. Skipped %d documents with length < %d" % ( len(doc_ids), short_documents, options.min_doc_length ) )
+		if len(classes) < 2:
+			log.warning( "No ground truth available" )
+			classes = None
+		else:
+			log.info( "Ground truth: %d classes - %s" % ( len(classes), label_count ) )
+	if not memo is None:
+		log.info( "Lemmatization memo: %d/%d lookups reused (%.1f%%), %d terms stored" % ( memo.hits, memo.hits + memo.misses, 100 * memo.hit_rate(), len(memo) ) )
+		if not options.memo_path is None:
+			memo.save( options.memo_path )
+	if not cache is None:
+		log.info( "Token cache: %d documents reused, %d documents read" % ( cache.hits, cache.misses ) )
+		cache.close()
 	log.info( "Built document-term matrix: %d documents, %d terms" % (X.shape[0], X.shape[1]) )
 	
 	# Store the corpus
 	prefix = options.prefix
 	if prefix is None:
-		prefix = "corpus"
+		if options.append_path is None:
+			prefix = "corpus"
+		else:
+			prefix = os.path.splitext( options.append_path )[0]
+	mmap = options.mmap or ( not options.append_path is None and text.util.is_mmap_corpus( options.append_path ) )
 	log.info( "Saving corpus '%s'" % prefix )
-	text.util.save_corpus( prefix, X, terms, doc_ids, classes )
+	text.util.save_corpus( prefix, X, terms, doc_ids, classes, info, mmap )
   
 # --------------------------------------------------------------
 
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 """
 Tool to parse a collection of documents, where each document is a single line in one or more text files.
+Input files compressed with gzip, bzip2 or xz are also supported, and "-" reads from standard input.
 
 Sample usage:
 python parse-file.py data/sample.txt -o sample --tfidf --norm
+zcat data/sample.txt.gz | python parse-file.py - -o sample --tfidf --norm
+python parse-file.py data/new.txt -a sample.pkl
 """
-import os, os.path, sys, codecs, re, unicodedata
+import os, os.path, sys, re, unicodedata
 import logging as log
 from optparse import OptionParser
 import text.util
@@ -16,55 +19,107 @@ def main():
 	parser = OptionParser(usage="usage: %prog [options] file1 file2 ...")
 	parser.add_option("-o", action="store", type="string", dest="prefix", help="output prefix for corpus files", default=None)
 	parser.add_option("--df", action="store", type="int", dest="min_df", help="minimum number of documents for a term to appear", default=20)
+	parser.add_option("--maxdf", action="store", type="float", dest="max_df", help="maximum proportion of documents (or number of documents, if > 1) in which a term can appear", default=1.0)
+	parser.add_option("--maxterms", action="store", type="int", dest="max_features", help="maximum number of terms, keeping those with the highest document frequencies", default=None)
+	parser.add_option("--budget", action="store", type="float", dest="max_memory", help="maximum size of the document-term matrix in MB, keeping the terms with the highest document frequencies", default=None)
 	parser.add_option("--tfidf", action="store_true", dest="apply_tfidf", help="apply TF-IDF term weight to the document-term matrix")
 	parser.add_option("--norm", action="store_true", dest="apply_norm", help="apply unit length normalization to the document-term matrix")
 	parser.add_option("--minlen", action="store", type="int", dest="min_doc_length", help="minimum document length (in characters)", default=50)
 	parser.add_option("-s", action="store", type="string", dest="stoplist_file", help="custom stopword file path", default=None)
+	parser.add_option("--lemmatize", action="store_true", dest="lemmatize", help="apply WordNet lemmatization to the tokens")
+	parser.add_option("--lemma-memo", action="store", type="string", dest="memo_path", help="file used to persist lemmatization results between runs", default=None)
+	parser.add_option("-a", "--append", action="store", type="string", dest="append_path", help="existing corpus file to which new documents are appended, using its vocabulary and term weights", default=None)
+	parser.add_option("--dtype", action="store", type="choice", choices=["float64","float32"], dest="dtype", help="precision of the weighted document-term matrix (float64 or float32)", default="float64")
+	parser.add_option("--mmap", action="store_true", dest="mmap", help="store the corpus as a directory of arrays which can be memory-mapped when loaded")
+	parser.add_option("--chunk", action="store", type="int", dest="chunk_size", help="number of documents to vectorize at a time", default=10000)
+	parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="number of worker processes used to tokenize documents (0 uses all cores)", default=1)
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 1 ):
 		parser.error( "Must specify at least one input file" )	
 	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(message)s')
+	if options.max_df > 1:
+		options.max_df = int(options.max_df)
 
-	# Read the documents
-	docs = []
+	# Fold new documents into an existing corpus?
+	base_doc_ids = []
+	if not options.append_path is None:
+		log.info( "Loading existing corpus from %s ..." % options.append_path )
+		(X_base,terms,base_doc_ids,base_classes,info) = text.util.load_corpus_info( options.append_path )
+		if info is None:
+			log.error( "Error: Corpus %s has no pre-processing information stored, so new documents cannot be folded in" % options.append_path )
+			sys.exit(1)
+		log.info( "Read corpus with %d documents, %d terms. Ignoring pre-processing options in favour of those stored with the corpus" % ( len(base_doc_ids), len(terms) ) )
+	else:
+		# Load the stopwords used to filter the documents
+		if options.stoplist_file is None:
+			stopwords = text.util.load_stopwords("text/stopwords.txt")
+		elif options.stoplist_file.lower() == "none":
+			log.info("Using no stopwords")
+			stopwords = set()
+		else:
+			log.info( "Using custom stopwords from %s" % options.stoplist_file )
+			stopwords = text.util.load_stopwords(options.stoplist_file)
+		tokenizer = text.util.DefaultTokenizer( lemmatize = options.lemmatize )
+
+	# Reuse lemmatization results from previous runs?
+	if not options.append_path is None:
+		tokenizer = info["params"]["tokenizer"]
+	memo = getattr( tokenizer, "memo", None )
+	if not ( memo is None or options.memo_path is None ) and os.path.exists( options.memo_path ):
+		memo.load( options.memo_path )
+		log.info( "Loaded %d lemmatized terms from %s" % ( len(memo), options.memo_path ) )
+
+	# Read the documents, which are passed to the pre-processing step as they are read
 	short_documents = 0
 	doc_ids = []
-	for in_path in args:
-		file_count = 0
-		log.info( "Reading documents from %s, one per line ..." % in_path )
-		fin = codecs.open(in_path, 'r', encoding="utf8", errors='ignore')
-		for line in fin.readlines():
-			body = line.strip()
-			if len(body) < options.min_doc_length:
-				short_documents += 1
-				continue
-			doc_id = "%05d" % ( len(doc_ids) + 1 )
-			docs.append(body)	
-			doc_ids.append(doc_id)	
-			file_count += 1
-		log.info( "Kept %d documents from %s" % (file_count, in_path) )
-	log.info( "Kept %d documents. Skipped %d documents with length < %d" % ( len(docs), short_documents, options.min_doc_length ) )
+	def generate_documents():
+		nonlocal short_documents
+		for in_path in args:
+			file_count = 0
+			log.info( "Reading documents from %s, one per line ..." % in_path )
+			for body in text.util.read_lines( in_path ):
+				if len(body) < options.min_doc_length:
+					short_documents += 1
+					continue
+				doc_id = "%05d" % ( len(base_doc_ids) + len(doc_ids) + 1 )
+				doc_ids.append(doc_id)	
+				file_count += 1
+				yield body
+			log.info( "Kept %d documents from %s" % (file_count, in_path) )
 
-	# Convert the documents in TF-IDF vectors and filter stopwords
-	if options.stoplist_file is None:
-		stopwords = text.util.load_stopwords("text/stopwords.txt")
-	elif options.stoplist_file.lower() == "none":
-		log.info("Using no stopwords")
-		stopwords = set()
+	if not options.append_path is None:
+		# Convert the new documents to vectors using the existing vocabulary
+		log.info( "Folding in new documents ..." )
+		X = text.util.fold_in_stream( generate_documents(), terms, info, chunk_size = options.chunk_size, jobs = options.jobs )
+		log.info( "Kept %d new documents. Skipped %d documents with length < %d" % ( len(doc_ids), short_documents, options.min_doc_length ) )
+		(X,doc_ids,classes) = text.util.append_corpus( X_base, base_doc_ids, base_classes, X, doc_ids )
 	else:
-		log.info( "Using custom stopwords from %s" % options.stoplist_file )
-		stopwords = text.util.load_stopwords(options.stoplist_file)
-	log.info( "Pre-processing data (%d stopwords, tfidf=%s, normalize=%s, min_df=%d) ..." % (len(stopwords), options.apply_tfidf, options.apply_norm, options.min_df) )
-	(X,terms) = text.util.preprocess( docs, stopwords, min_df = options.min_df, apply_tfidf = options.apply_tfidf, apply_norm = options.apply_norm )
+		# Convert the documents in TF-IDF vectors and filter stopwords
+		log.info( "Pre-processing data (%d stopwords, tfidf=%s, normalize=%s, min_df=%d) ..." % (len(stopwords), options.apply_tfidf, options.apply_norm, options.min_df) )
+		(X,terms,info) = text.util.preprocess_stream( generate_documents(), stopwords, min_df = options.min_df, apply_tfidf = options.apply_tfidf, apply_norm = options.apply_norm, tokenizer = tokenizer, chunk_size = options.chunk_size, return_info = True, jobs = options.jobs,
+			max_df = options.max_df, max_features = options.max_features, max_memory = options.max_memory, return_counts = True, dtype = options.dtype )
+		log.info( "Storing raw term counts, term weighting will be applied when the corpus is loaded" )
+		log.info( "Pruned vocabulary from %d to %d terms (%.1f%%), non-zero entries from %d to %d (%.1f%%)" % ( info["unpruned_terms"], X.shape[1], 
+			100.0 * X.shape[1] / max( info["unpruned_terms"], 1 ), info["unpruned_nnz"], X.nnz, 100.0 * X.nnz / max( info["unpruned_nnz"], 1 ) ) )
+		log.info( "Kept %d documents. Skipped %d documents with length < %d" % ( len(doc_ids), short_documents, options.min_doc_length ) )
+		classes = None
+	if not memo is None:
+		log.info( "Lemmatization memo: %d/%d lookups reused (%.1f%%), %d terms stored" % ( memo.hits, memo.hits + memo.misses, 100 * memo.hit_rate(), len(memo) ) )
+		if not options.memo_path is None:
+			memo.save( options.memo_path )
 	log.info( "Built document-term matrix: %d documents, %d terms" % (X.shape[0], X.shape[1]) )
 	
 	# Store the corpus
 	prefix = options.prefix
 	if prefix is None:
-		prefix = "corpus"
+		if options.append_path is None:
+			prefix = "corpus"
+		else:
+			prefix = os.path.splitext( options.append_path )[0]
+	mmap = options.mmap or ( not options.append_path is None and text.util.is_mmap_corpus( options.append_path ) )
 	log.info( "Saving corpus '%s'" % prefix )
-	text.util.save_corpus( prefix, X, terms, doc_ids, None )
+	text.util.save_corpus( prefix, X, terms, doc_ids, classes, info, mmap )
   
 # --------------------------------------------------------------
 
@@ -1,102 +1,637 @@
-import codecs, os, os.path, re
+import array, bz2, codecs, gzip, hashlib, lzma, numbers, os, os.path, pickle, re, sqlite3, sys, tarfile, zipfile
+import collections, multiprocessing
+import numpy as np
+from scipy import sparse as sp
 from sklearn.externals import joblib
+import sklearn.preprocessing
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+# regular expression used to strip URIs from document text
+http_re = re.compile(r'https?[:;]?/?/?\S*')
+
+# file extensions of the archive formats which can be parsed without extraction
+archive_extensions = [".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz"]
+
+# directory extension used for corpora stored as memory-mapped arrays
+mmap_corpus_extension = ".corpus"
+
+# --------------------------------------------------------------
+# Tokenizers
 # --------------------------------------------------------------
 
-def preprocess( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True, lemmatize = False ):
+class LRUMemo:
 	"""
-	Preprocess a list containing text documents stored as strings.
+	Bounded memo table which stores the results of a function for previously seen keys, discarding the least recently
+	used entries once the table is full. The hit rate is tracked, and the table can be persisted between runs.
 	"""
-	token_pattern = re.compile(r"\b\w\w+\b", re.U)
+	def __init__( self, max_size = 100000 ):
+		self.max_size = max_size
+		self.table = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		# entries added since the last call to pop_updates(), if these are being tracked
+		self.added = None
+		self.added_hits = 0
+
+	def lookup( self, key, func ):
+		"""
+		Return the value for the specified key, calling the function to compute it if it is not already in the table.
+		"""
+		try:
+			value = self.table[key]
+		except KeyError:
+			value = func(key)
+			self.misses += 1
+			self.table[key] = value
+			if not self.added is None:
+				self.added.append( (key, value) )
+			if len(self.table) > self.max_size:
+				self.table.popitem( last = False )
+			return value
+		self.table.move_to_end( key )
+		self.hits += 1
+		return value
+
+	def hit_rate( self ):
+		total = self.hits + self.misses
+		if total == 0:
+			return 0.0
+		return float(self.hits)/total
+
+	def track_updates( self ):
+		"""
+		Start tracking the entries added to the table, which are returned by pop_updates().
+		"""
+		self.added = []
+		self.added_hits = self.hits
 
-	if lemmatize:
-		from nltk.stem import WordNetLemmatizer
-		wnl = WordNetLemmatizer()
+	def pop_updates( self ):
+		"""
+		Return the entries added and the lookup counts since the last call, so that they can be merged into another table
+		(e.g. from a worker process back into the parent process).
+		"""
+		updates = ( self.added, self.hits - self.added_hits, len(self.added) )
+		self.track_updates()
+		return updates
+
+	def merge_updates( self, updates ):
+		"""
+		Merge entries and lookup counts returned by pop_updates() on another table.
+		"""
+		(entries, hits, misses) = updates
+		for key, value in entries:
+			self.table[key] = value
+			self.table.move_to_end( key )
+		while len(self.table) > self.max_size:
+			self.table.popitem( last = False )
+		self.hits += hits
+		self.misses += misses
+
+	def save( self, out_path ):
+		"""
+		Save the contents of the table using Pickle.
+		"""
+		with open( out_path, "wb" ) as fout:
+			pickle.dump( list(self.table.items()), fout, protocol = pickle.HIGHEST_PROTOCOL )
+
+	def load( self, in_path ):
+		"""
+		Load entries previously saved using save() into the table.
+		"""
+		with open( in_path, "rb" ) as fin:
+			entries = pickle.load( fin )
+		for key, value in entries[-self.max_size:]:
+			self.table[key] = value
+		while len(self.table) > self.max_size:
+			self.table.popitem( last = False )
+
+	def __len__( self ):
+		return len(self.table)
+
+	def __getstate__( self ):
+		# NB: the lookup counts are specific to each process
+		state = self.__dict__.copy()
+		state["hits"] = state["misses"] = state["added_hits"] = 0
+		state["added"] = None
+		return state
+
+class DefaultTokenizer:
+	"""
+	Tokenizer which extracts alphabetic word tokens from text, optionally applying lemmatization. Since most token 
+	occurrences repeat a small number of surface forms, lemmatization results are memoized in a bounded table.
+	"""
+	token_pattern = re.compile(r"\b\w\w+\b", re.U)
 
-	def normalize( x ):
-		x = x.lower()
+	def __init__( self, min_term_length = 2, lemmatize = False, memo_size = 100000 ):
+		self.min_term_length = min_term_length
+		self.lemmatize = lemmatize
+		self.wnl = None
 		if lemmatize:
-			return wnl.lemmatize(x)
-		return x
+			self.memo = LRUMemo( memo_size )
+		else:
+			self.memo = None
 
-	def custom_tokenizer( s ):
-		return [normalize(x) for x in token_pattern.findall(s) if (len(x) >= min_term_length and x[0].isalpha() ) ]
+	def get_params( self ):
+		"""
+		Return the parameters which determine the tokens produced by this tokenizer.
+		"""
+		return { "min_term_length" : self.min_term_length, "lemmatize" : self.lemmatize }
 
-	# Build the Vector Space Model, apply TF-IDF and normalize lines to unit length all in one call
-	if apply_norm:
-		norm_function = "l2"
-	else:
-		norm_function = None
-	tfidf = TfidfVectorizer(stop_words=stopwords, lowercase=True, strip_accents="unicode", tokenizer=custom_tokenizer, use_idf=apply_tfidf, norm=norm_function, min_df = min_df, ngram_range = ngram_range) 
-	X = tfidf.fit_transform(docs)
-	terms = []
-	# store the vocabulary map
-	v = tfidf.vocabulary_
-	for i in range(len(v)):
-		terms.append("")
-	for term in v.keys():
-		terms[ v[term] ] = term
-	return (X,terms)
+	def lemmatize_token( self, x ):
+		if self.wnl is None:
+			from nltk.stem import WordNetLemmatizer
+			self.wnl = WordNetLemmatizer()
+		return self.wnl.lemmatize( x.lower() )
 
-def preprocess_simple( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True ):
+	def normalize( self, x ):
+		if self.lemmatize:
+			return self.memo.lookup( x, self.lemmatize_token )
+		return x.lower()
+
+	def __call__( self, s ):
+		return [self.normalize(x) for x in self.token_pattern.findall(s) if (len(x) >= self.min_term_length and x[0].isalpha() ) ]
+
+	def __getstate__( self ):
+		# NB: the lemmatizer is recreated on demand, so that the tokenizer can be sent to worker processes
+		state = self.__dict__.copy()
+		state["wnl"] = None
+		return state
+
+class SimpleTokenizer:
 	"""
-	Preprocess a list containing text documents stored as strings, where the documents have already been tokenized and are separated by whitespace
+	Tokenizer for text which has already been tokenized, where the tokens are separated by whitespace.
 	"""
 	token_pattern = re.compile(r"[\s\-]+", re.U)
 
-	def custom_tokenizer( s ):
-		return [x.lower() for x in token_pattern.split(s) if (len(x) >= min_term_length) ]
+	def __init__( self, min_term_length = 2 ):
+		self.min_term_length = min_term_length
 
-	# Build the Vector Space Model, apply TF-IDF and normalize lines to unit length all in one call
-	if apply_norm:
-		norm_function = "l2"
-	else:
-		norm_function = None
-	tfidf = TfidfVectorizer(stop_words=stopwords, lowercase=True, strip_accents="unicode", tokenizer=custom_tokenizer, use_idf=apply_tfidf, norm=norm_function, min_df = min_df, ngram_range = ngram_range) 
-	X = tfidf.fit_transform(docs)
-	terms = []
-	# store the vocabulary map
-	v = tfidf.vocabulary_
-	for i in range(len(v)):
-		terms.append("")
-	for term in v.keys():
-		terms[ v[term] ] = term
-	return (X,terms)
+	def get_params( self ):
+		return { "min_term_length" : self.min_term_length }
 
-def preprocess_tweets( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True):
+	def __call__( self, s ):
+		return [x.lower() for x in self.token_pattern.split(s) if (len(x) >= self.min_term_length) ]
+
+class TweetTokenizer:
 	"""
-	Preprocess a list containing text documents stored as strings, where the documents have already been tokenized and are separated by whitespace
+	Tokenizer for short social media posts, backed by the NLTK TweetTokenizer.
 	"""
-	from nltk.tokenize import TweetTokenizer
-	tweet_tokenizer = TweetTokenizer(preserve_case = False, strip_handles=True, reduce_len=True)
+	def __init__( self, min_term_length = 2 ):
+		self.min_term_length = min_term_length
+		self.tweet_tokenizer = None
+
+	def get_params( self ):
+		return { "min_term_length" : self.min_term_length }
 
-	def custom_tokenizer( s ):
+	def __call__( self, s ):
+		if self.tweet_tokenizer is None:
+			from nltk.tokenize import TweetTokenizer as NLTKTweetTokenizer
+			self.tweet_tokenizer = NLTKTweetTokenizer(preserve_case = False, strip_handles=True, reduce_len=True)
 		# need to manually replace quotes
 		s = s.replace("'"," ").replace('"',' ')
 		tokens = []
-		for x in tweet_tokenizer.tokenize(s):
-			if len(x) >= min_term_length:
+		for x in self.tweet_tokenizer.tokenize(s):
+			if len(x) >= self.min_term_length:
 				if x[0] == "#" or x[0].isalpha():
 					tokens.append( x )
 		return tokens
 
-	# Build the Vector Space Model, apply TF-IDF and normalize lines to unit length all in one call
+	def __getstate__( self ):
+		state = self.__dict__.copy()
+		state["tweet_tokenizer"] = None
+		return state
+
+# --------------------------------------------------------------
+# Vector Space Model
+# --------------------------------------------------------------
+
+def build_vectorizer( tokenizer, stopwords, min_df = 3, ngram_range = (1,1), apply_tfidf = True, apply_norm = True ):
+	"""
+	Create a scikit-learn vectorizer which builds the Vector Space Model, applies TF-IDF and normalizes lines to unit length.
+	"""
 	if apply_norm:
 		norm_function = "l2"
 	else:
 		norm_function = None
-	tfidf = TfidfVectorizer(stop_words=stopwords, lowercase=True, strip_accents="unicode", tokenizer=custom_tokenizer, use_idf=apply_tfidf, norm=norm_function, min_df = min_df, ngram_range = ngram_range) 
-	X = tfidf.fit_transform(docs)
+	return TfidfVectorizer(stop_words=stopwords, lowercase=True, strip_accents="unicode", tokenizer=tokenizer, use_idf=apply_tfidf, norm=norm_function, min_df = min_df, ngram_range = ngram_range) 
+
+def vocabulary_to_terms( v ):
+	"""
+	Convert a vocabulary map of terms to column indices into a list of terms.
+	"""
 	terms = []
-	# store the vocabulary map
-	v = tfidf.vocabulary_
 	for i in range(len(v)):
 		terms.append("")
 	for term in v.keys():
 		terms[ v[term] ] = term
+	return terms
+
+def preprocess( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True, lemmatize = False, jobs = 1, max_df = 1.0, max_features = None, max_memory = None, dtype = "float64" ):
+	"""
+	Preprocess a list containing text documents stored as strings. If jobs is not 1, the documents are tokenized 
+	in parallel using the specified number of worker processes (a value < 1 uses all available cores). The size of the 
+	vocabulary can be limited using max_df, max_features (the number of terms with the highest document frequencies)
+	or max_memory (the size of the document-term matrix in megabytes). The weights are computed in double precision,
+	and then stored in the matrix using the specified dtype.
+	"""
+	if jobs != 1 or not ( max_features is None and max_memory is None ):
+		return preprocess_stream( docs, stopwords, min_df, min_term_length, ngram_range, apply_tfidf, apply_norm, lemmatize, jobs = jobs, max_df = max_df, max_features = max_features, max_memory = max_memory, dtype = dtype )
+	tokenizer = DefaultTokenizer( min_term_length, lemmatize )
+	tfidf = build_vectorizer( tokenizer, stopwords, min_df, ngram_range, apply_tfidf, apply_norm )
+	tfidf.set_params( max_df = max_df )
+	X = tfidf.fit_transform(docs).astype( dtype, copy=False )
+	return (X, vocabulary_to_terms( tfidf.vocabulary_ ))
+
+def preprocess_simple( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True ):
+	"""
+	Preprocess a list containing text documents stored as strings, where the documents have already been tokenized and are separated by whitespace
+	"""
+	tokenizer = SimpleTokenizer( min_term_length )
+	tfidf = build_vectorizer( tokenizer, stopwords, min_df, ngram_range, apply_tfidf, apply_norm )
+	X = tfidf.fit_transform(docs)
+	return (X, vocabulary_to_terms( tfidf.vocabulary_ ))
+
+def preprocess_tweets( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True):
+	"""
+	Preprocess a list containing text documents stored as strings, where the documents have already been tokenized and are separated by whitespace
+	"""
+	tokenizer = TweetTokenizer( min_term_length )
+	tfidf = build_vectorizer( tokenizer, stopwords, min_df, ngram_range, apply_tfidf, apply_norm )
+	X = tfidf.fit_transform(docs)
+	return (X, vocabulary_to_terms( tfidf.vocabulary_ ))
+
+# --------------------------------------------------------------
+# Chunked Vector Space Model
+# --------------------------------------------------------------
+
+def preprocess_stream( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True, lemmatize = False, tokenizer = None, chunk_size = 10000, return_info = False, jobs = 1, max_df = 1.0, max_features = None, max_memory = None, return_counts = False, dtype = "float64" ):
+	"""
+	Preprocess an iterable (e.g. a generator) of text documents stored as strings, without holding all of the text in memory.
+	The documents are tokenized and counted in chunks of the specified size. Once all chunks have been counted, min_df is applied
+	and the TF-IDF weighting and normalization are applied to the pruned count matrix. The output is the same as preprocess().
+	If return_info is True, a dictionary containing the pre-processing parameters and document frequencies is also returned,
+	which can be stored with the corpus and later used to fold in new documents. If jobs is not 1, the chunks are 
+	tokenized and counted in parallel by the specified number of worker processes. See prune_vocabulary() for the 
+	vocabulary budget options max_df, max_features and max_memory. If return_counts is True, the term weighting is not 
+	applied and the raw term counts are returned instead, so that the weighting can be applied later by weight_corpus().
+	The dtype specifies the precision of the weighted matrix.
+	"""
+	if tokenizer is None:
+		tokenizer = DefaultTokenizer( min_term_length, lemmatize )
+	params = build_params( tokenizer, stopwords, min_df, ngram_range, apply_tfidf, apply_norm, max_df, max_features, max_memory, dtype )
+	if jobs == 1:
+		analyzer = build_analyzer( params )
+		term_counts = ( count_document_terms( doc, analyzer ) for doc in docs )
+		return preprocess_term_counts( term_counts, params, chunk_size, return_info, return_counts )
+	# merge the vocabularies of the chunks in their original order, so that the term indices match the serial case
+	vocabulary = {}
+	chunks = []
+	for (chunk_terms, C) in count_chunks_parallel( docs, params, chunk_size, jobs ):
+		chunks.append( merge_count_matrix( C, chunk_terms, vocabulary ) )
+	X = stack_counts( chunks, len(vocabulary) )
+	del chunks
+	return finalize_counts( X, vocabulary, params, return_info, return_counts )
+
+def preprocess_term_counts( term_counts, params, chunk_size = 10000, return_info = False, return_counts = False ):
+	"""
+	Build a document-term matrix from an iterable of per-document term count maps, which were produced by the analyzer 
+	for the specified pre-processing parameters. Returns the same output as preprocess_stream().
+	"""
+	# first pass: build count matrices for each chunk of documents
+	vocabulary = {}
+	X = stack_counts( [build_count_matrix( chunk, vocabulary ) for chunk in iter_chunks( term_counts, chunk_size )], len(vocabulary) )
+	return finalize_counts( X, vocabulary, params, return_info, return_counts )
+
+def finalize_counts( X, vocabulary, params, return_info = False, return_counts = False ):
+	"""
+	Prune the vocabulary of a document-term count matrix and apply the term weighting, based on the specified pre-processing 
+	parameters. If return_counts is True, the pruned count matrix is returned without any weighting.
+	"""
+	(n_terms, nnz) = ( len(vocabulary), X.nnz )
+	(X,terms) = prune_vocabulary( X, vocabulary, params["min_df"], params.get("max_df", 1.0), params.get("max_features"), params.get("max_memory"), params.get("dtype", "float64") )
+	info = { "params" : params, "n_docs" : X.shape[0], "df" : document_frequencies( X ), "counts" : return_counts, 
+		"unpruned_terms" : n_terms, "unpruned_nnz" : nnz }
+	if not return_counts:
+		X = weight_corpus( X, info )
+	if not return_info:
+		return (X,terms)
+	return (X,terms,info)
+
+def fold_in_stream( docs, terms, info, chunk_size = 10000, jobs = 1 ):
+	"""
+	Vectorize an iterable of new text documents against the fixed vocabulary and IDF weights of an existing corpus, 
+	using the pre-processing information stored with that corpus. Terms which are not in the vocabulary are ignored.
+	"""
+	if jobs == 1:
+		analyzer = build_analyzer( info["params"] )
+		term_counts = ( count_document_terms( doc, analyzer ) for doc in docs )
+		return fold_in_term_counts( term_counts, terms, info, chunk_size )
+	vocabulary = build_vocabulary( terms )
+	chunks = []
+	for (chunk_terms, C) in count_chunks_parallel( docs, info["params"], chunk_size, jobs ):
+		chunks.append( merge_count_matrix( C, chunk_terms, vocabulary, fixed_vocabulary = True ) )
+	return fold_in_counts( stack_counts( chunks, len(vocabulary) ), info )
+
+def fold_in_term_counts( term_counts, terms, info, chunk_size = 10000 ):
+	"""
+	Vectorize an iterable of per-document term count maps against the fixed vocabulary and IDF weights of an existing corpus.
+	"""
+	vocabulary = build_vocabulary( terms )
+	X = stack_counts( [build_count_matrix( chunk, vocabulary, fixed_vocabulary = True ) for chunk in iter_chunks( term_counts, chunk_size )], len(vocabulary) )
+	return fold_in_counts( X, info )
+
+def fold_in_counts( X, info ):
+	"""
+	Apply the fixed IDF weights and normalization of an existing corpus to a document-term count matrix. If the existing 
+	corpus stores raw term counts, the counts are returned unweighted.
+	"""
+	X.sort_indices()
+	if is_count_corpus( info ):
+		return X
+	return weight_corpus( X, info )
+
+def is_count_corpus( info ):
+	"""
+	Check whether a corpus with the specified pre-processing information stores raw term counts, rather than weighted values.
+	"""
+	return not info is None and info.get( "counts", False )
+
+def weight_corpus( X, info, apply_tfidf = None, apply_norm = None, dtype = None ):
+	"""
+	Apply term weighting to a document-term count matrix, using the document frequencies in the specified pre-processing 
+	information. Unless overridden, the TF-IDF, normalization and precision settings chosen when the corpus was parsed are used.
+	"""
+	params = info["params"]
+	if apply_tfidf is None:
+		apply_tfidf = params["apply_tfidf"]
+	if apply_norm is None:
+		apply_norm = params["apply_norm"]
+	if dtype is None:
+		dtype = params.get( "dtype", "float64" )
+	if apply_tfidf:
+		idf = compute_idf( info["df"], info["n_docs"] )
+	else:
+		idf = None
+	return weight_counts( X, idf, apply_norm, dtype )
+
+def build_vocabulary( terms ):
+	"""
+	Convert a list of terms into a vocabulary map of terms to column indices.
+	"""
+	vocabulary = {}
+	for term_index, term in enumerate(terms):
+		vocabulary[term] = term_index
+	return vocabulary
+
+def build_params( tokenizer, stopwords, min_df = 3, ngram_range = (1,1), apply_tfidf = True, apply_norm = True, max_df = 1.0, max_features = None, max_memory = None, dtype = "float64" ):
+	"""
+	Create a dictionary of the parameters used to pre-process a corpus.
+	"""
+	return { "tokenizer" : tokenizer, "stopwords" : sorted(stopwords), "min_df" : min_df, "ngram_range" : ngram_range,
+		"apply_tfidf" : apply_tfidf, "apply_norm" : apply_norm, "max_df" : max_df, "max_features" : max_features, "max_memory" : max_memory,
+		"dtype" : dtype }
+
+def build_analyzer( params ):
+	"""
+	Create the function which converts a document to a sequence of terms, based on the specified pre-processing parameters.
+	"""
+	return build_vectorizer( params["tokenizer"], params["stopwords"], params["min_df"], params["ngram_range"], params["apply_tfidf"], params["apply_norm"] ).build_analyzer()
+
+def count_document_terms( doc, analyzer ):
+	"""
+	Count the terms in a single document using the specified analyzer. The terms are stored in order of first occurrence.
+	"""
+	counts = {}
+	for term in analyzer(doc):
+		counts[term] = counts.get( term, 0 ) + 1
+	return counts
+
+def iter_chunks( docs, chunk_size ):
+	"""
+	Split an iterable of documents into lists of up to the specified size.
+	"""
+	chunk = []
+	for doc in docs:
+		chunk.append( doc )
+		if len(chunk) >= chunk_size:
+			yield chunk
+			chunk = []
+	if len(chunk) > 0:
+		yield chunk
+
+def build_count_matrix( term_counts, vocabulary, fixed_vocabulary = False ):
+	"""
+	Build a sparse document-term count matrix from a list of per-document term count maps, adding any new terms to the 
+	vocabulary map unless the vocabulary is fixed. The matrix covers the current vocabulary.
+	"""
+	indices = array.array("i")
+	values = array.array("i")
+	indptr = array.array("l", [0])
+	for counts in term_counts:
+		for term, count in counts.items():
+			if fixed_vocabulary:
+				term_index = vocabulary.get( term, -1 )
+				if term_index < 0:
+					continue
+			else:
+				term_index = vocabulary.setdefault( term, len(vocabulary) )
+			indices.append( term_index )
+			values.append( count )
+		indptr.append( len(indices) )
+	return sp.csr_matrix( (np.frombuffer(values, dtype=np.intc), np.frombuffer(indices, dtype=np.intc), np.frombuffer(indptr, dtype=np.int_)), shape=(len(term_counts), len(vocabulary)) )
+
+def stack_counts( chunks, n_terms ):
+	"""
+	Stack a list of sparse count matrices, built on a growing vocabulary, into a single matrix with the specified number of columns.
+	"""
+	if len(chunks) == 0:
+		return sp.csr_matrix( (0, n_terms), dtype=np.intc )
+	resized = []
+	for C in chunks:
+		resized.append( sp.csr_matrix( (C.data, C.indices, C.indptr), shape=(C.shape[0], n_terms) ) )
+	return sp.vstack( resized, format="csr" )
+
+def merge_count_matrix( C, chunk_terms, vocabulary, fixed_vocabulary = False ):
+	"""
+	Map the columns of a count matrix built on a local chunk vocabulary, given as a list of terms, onto the global 
+	vocabulary map. New terms are added in their local order unless the vocabulary is fixed, in which case they are removed.
+	"""
+	if fixed_vocabulary:
+		map_index = np.array( [vocabulary.get( term, -1 ) for term in chunk_terms], dtype=np.intc )
+	else:
+		map_index = np.array( [vocabulary.setdefault( term, len(vocabulary) ) for term in chunk_terms], dtype=np.intc )
+	indices = map_index.take( C.indices )
+	if not fixed_vocabulary or len(indices) == 0 or indices.min() >= 0:
+		return sp.csr_matrix( (C.data, indices, C.indptr), shape=(C.shape[0], len(vocabulary)) )
+	# remove the entries for unknown terms
+	mask = indices >= 0
+	rows = np.repeat( np.arange( C.shape[0] ), np.diff( C.indptr ) )
+	indptr = np.concatenate( ( [0], np.cumsum( np.bincount( rows[mask], minlength = C.shape[0] ) ) ) )
+	return sp.csr_matrix( (C.data[mask], indices[mask], indptr), shape=(C.shape[0], len(vocabulary)) )
+
+def prune_vocabulary( X, vocabulary, min_df = 1, max_df = 1.0, max_features = None, max_memory = None, dtype = "float64" ):
+	"""
+	Remove terms appearing in fewer than min_df or more than max_df documents from a document-term count matrix, and sort 
+	the remaining terms alphabetically, as is done by the scikit-learn vectorizers. A float value for min_df or max_df is 
+	treated as a proportion of documents. If max_features is specified, only that number of terms with the highest document 
+	frequencies are kept. If max_memory is specified, the most frequent terms are kept for which the weighted matrix fits 
+	within that number of megabytes, when its weights are stored using the specified dtype. Returns the pruned matrix and 
+	the corresponding list of terms.
+	"""
+	if isinstance( min_df, numbers.Integral ):
+		min_doc_count = min_df
+	else:
+		min_doc_count = min_df * X.shape[0]
+	if isinstance( max_df, numbers.Integral ):
+		max_doc_count = max_df
+	else:
+		max_doc_count = max_df * X.shape[0]
+	# sort the terms, remapping the column indices in place
+	terms = sorted( vocabulary.keys() )
+	map_index = np.empty( len(terms), dtype=X.indices.dtype )
+	for new_index, term in enumerate(terms):
+		map_index[vocabulary[term]] = new_index
+	X.sort_indices()
+	X.indices = map_index.take( X.indices, mode="clip" )
+	X.has_sorted_indices = False
+	# now remove the infrequent and overly common terms
+	df = document_frequencies( X )
+	keep = ( df >= min_doc_count ) & ( df <= max_doc_count )
+	# apply the vocabulary budget, keeping the terms with the highest document frequencies
+	if not ( max_features is None and max_memory is None ):
+		ranked = np.where(keep)[0]
+		ranked = ranked[np.argsort( -df[ranked], kind="mergesort" )]
+		n_keep = len(ranked)
+		if not max_features is None:
+			n_keep = min( n_keep, max_features )
+		if not max_memory is None:
+			# each non-zero entry stores a weight and an int32 column index
+			entry_bytes = np.dtype(dtype).itemsize + X.indices.itemsize
+			available = max_memory * 1024 * 1024 - ( X.shape[0] + 1 ) * X.indptr.itemsize
+			n_keep = min( n_keep, np.searchsorted( np.cumsum( df[ranked] ) * entry_bytes, available, side="right" ) )
+		keep = np.zeros( len(terms), dtype=bool )
+		keep[ranked[:n_keep]] = True
+	if not keep.any():
+		raise ValueError("After pruning, no terms remain. Try a lower min_df, a higher max_df or a larger vocabulary budget.")
+	terms = [term for term, kept in zip(terms, keep) if kept]
+	X = X[:,np.where(keep)[0]]
 	return (X,terms)
 
+def document_frequencies( X ):
+	"""
+	Return the number of documents containing each term in a sparse document-term matrix.
+	"""
+	return np.bincount( X.indices, minlength = X.shape[1] )
+
+def compute_idf( df, n_docs ):
+	"""
+	Compute smoothed IDF term weights from document frequencies, as is done by the scikit-learn TfidfTransformer.
+	"""
+	return np.log( float(n_docs + 1) / ( np.asarray(df, dtype=np.float64) + 1 ) ) + 1.0
+
+def weight_counts( X, idf = None, apply_norm = True, dtype = "float64" ):
+	"""
+	Apply the specified IDF term weights (if any) and unit length normalization to a sparse document-term count matrix.
+	The weights are computed in double precision, and then converted to the specified dtype.
+	"""
+	X = sp.csr_matrix( X, dtype=np.float64 )
+	if idf is not None:
+		X = X * sp.diags( idf, 0, shape=(len(idf), len(idf)), format="csr" )
+	if apply_norm:
+		X = sklearn.preprocessing.normalize( X, norm="l2", copy=False )
+	return X.astype( dtype, copy=False )
+
+# --------------------------------------------------------------
+# Parallel Tokenization
+# --------------------------------------------------------------
+
+# analyzer and tokenizer used by each worker process, created when the worker starts
+worker_analyzer = None
+worker_tokenizer = None
+
+def init_worker( params ):
+	"""
+	Initialize a worker process by creating the analyzer for the specified pre-processing parameters.
+	"""
+	global worker_analyzer, worker_tokenizer
+	worker_analyzer = build_analyzer( params )
+	worker_tokenizer = params["tokenizer"]
+	# NB: only report the changes made to the memo table in this worker
+	memo = getattr( worker_tokenizer, "memo", None )
+	if not memo is None:
+		memo.track_updates()
+
+def pop_memo_updates( tokenizer ):
+	"""
+	Return the updates to the memo table of the specified tokenizer since the last call, or None if it has no memo table.
+	"""
+	memo = getattr( tokenizer, "memo", None )
+	if memo is None:
+		return None
+	return memo.pop_updates()
+
+def merge_memo_updates( tokenizer, updates ):
+	"""
+	Merge updates to a memo table, returned by a worker process, into the memo table of the specified tokenizer.
+	"""
+	memo = getattr( tokenizer, "memo", None )
+	if not ( memo is None or updates is None ):
+		memo.merge_updates( updates )
+
+def count_chunk( docs ):
+	"""
+	Count the terms in a chunk of documents in a worker process, returning the local chunk vocabulary as a list of terms,
+	the corresponding sparse count matrix and any updates to the memo table of the tokenizer.
+	"""
+	vocabulary = {}
+	C = build_count_matrix( [count_document_terms( doc, worker_analyzer ) for doc in docs], vocabulary )
+	return ( list(vocabulary.keys()), C, pop_memo_updates( worker_tokenizer ) )
+
+def read_and_count( in_path ):
+	"""
+	Read and tokenize a single document file in a worker process, returning its text length and term counts, along 
+	with any updates to the memo table of the tokenizer.
+	"""
+	body = read_text( in_path )
+	return ( ( len(body), count_document_terms( body, worker_analyzer ) ), pop_memo_updates( worker_tokenizer ) )
+
+def count_archive_batch( entries ):
+	"""
+	Normalize and tokenize a batch of archive entries in a worker process, returning the results of 
+	count_archive_entries() and any updates to the memo table of the tokenizer.
+	"""
+	return ( count_archive_entries( entries, worker_analyzer ), pop_memo_updates( worker_tokenizer ) )
+
+def imap_bounded( pool, func, iterable, max_pending ):
+	"""
+	Apply a function to each item of an iterable using a pool of worker processes, yielding the results in order. 
+	Unlike Pool.imap, at most max_pending items are read from the iterable ahead of the results being consumed.
+	"""
+	pending = collections.deque()
+	for item in iterable:
+		pending.append( pool.apply_async( func, (item,) ) )
+		if len(pending) >= max_pending:
+			yield pending.popleft().get()
+	while len(pending) > 0:
+		yield pending.popleft().get()
+
+def count_chunks_parallel( docs, params, chunk_size = 10000, jobs = 0 ):
+	"""
+	Tokenize and count chunks of documents in parallel, yielding the vocabulary and count matrix for each chunk in order.
+	"""
+	if jobs < 1:
+		jobs = multiprocessing.cpu_count()
+	pool = multiprocessing.Pool( jobs, init_worker, (params,) )
+	try:
+		# NB: limit the number of chunks held in memory at once
+		for (chunk_terms, C, updates) in imap_bounded( pool, count_chunk, iter_chunks( docs, chunk_size ), 2 * jobs ):
+			merge_memo_updates( params["tokenizer"], updates )
+			yield (chunk_terms, C)
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
 # --------------------------------------------------------------
 
 def load_stopwords( inpath = "text/stopwords.txt"):
@@ -112,19 +647,243 @@ def load_stopwords( inpath = "text/stopwords.txt"):
 				stopwords.add(l)
 	return stopwords
 
-def save_corpus( out_prefix, X, terms, doc_ids, classes = None ):
+def save_corpus( out_prefix, X, terms, doc_ids, classes = None, info = None, mmap = False ):
 	"""
-	Save a pre-processed scikit-learn corpus and associated metadata using Joblib.
+	Save a pre-processed scikit-learn corpus and associated metadata using Joblib. The optional pre-processing
+	information is required to later fold in new documents. If mmap is True, the corpus is stored as a directory
+	of arrays which can be memory-mapped when loaded. In both formats, the classes are stored as an array of class 
+	indices.
 	"""
+	if mmap:
+		save_mmap_corpus( "%s%s" % ( out_prefix, mmap_corpus_extension ), X, terms, doc_ids, classes, info )
+		return
 	matrix_outpath = "%s.pkl" % out_prefix 
-	joblib.dump((X,terms,doc_ids,classes), matrix_outpath ) 
+	(labels, class_names) = classes_to_labels( classes, doc_ids )
+	joblib.dump((X,terms,doc_ids,labels,class_names,info), matrix_outpath ) 
+
+def load_corpus( in_path, apply_tfidf = None, apply_norm = None, dtype = None ):
+	"""
+	Load a pre-processed scikit-learn corpus and associated metadata using Joblib. For corpora which store raw term counts,
+	the term weighting is applied as the corpus is loaded. By default, the TF-IDF, normalization and precision settings 
+	chosen when the corpus was parsed are used, but these can be overridden. Memory-mapped corpora are opened without 
+	reading the matrix into memory, unless these settings are overridden.
+	"""
+	reader = CorpusReader( in_path )
+	X = reader.matrix( apply_tfidf, apply_norm, dtype )
+	return (X, reader.get("terms"), reader.get("doc_ids"), reader.get("classes"))
+
+def load_corpus_info( in_path ):
+	"""
+	Load a pre-processed scikit-learn corpus, associated metadata and pre-processing information using Joblib.
+	The pre-processing information will be None for corpora which were saved without it. No term weighting is applied, 
+	so the matrix contains raw term counts if is_count_corpus() is True.
+	"""
+	return load_corpus_fields( in_path, ["counts","terms","doc_ids","classes","info"] )
+
+def load_corpus_fields( in_path, fields, apply_tfidf = None, apply_norm = None, dtype = None ):
+	"""
+	Load only the specified fields of a corpus, returned as a tuple in the same order. The available fields are:
+	X (the weighted document-term matrix), counts (the matrix without any weighting applied), terms, doc_ids, 
+	classes, labels (an array giving the class index of each document, or -1 if it has no class), class_names and info.
+	For memory-mapped corpora, fields which are not requested are not read.
+	"""
+	reader = CorpusReader( in_path )
+	values = []
+	for field in fields:
+		if field == "X":
+			values.append( reader.matrix( apply_tfidf, apply_norm, dtype ) )
+		else:
+			values.append( reader.get( field ) )
+	return tuple(values)
+
+class CorpusReader:
+	"""
+	Reads the fields of a stored corpus on demand. For memory-mapped corpora, each field is stored separately, so only 
+	the fields which are requested are read. For corpora stored in a single Joblib file, all fields are read at once, 
+	except that the arrays of the matrix are only memory-mapped unless the matrix is requested.
+	"""
+	def __init__( self, in_path ):
+		self.in_path = in_path
+		self.mmap = is_mmap_corpus( in_path )
+		self.values = {}
+
+	def get( self, field ):
+		if not field in self.values:
+			self.values[field] = self.read( field )
+		return self.values[field]
+
+	def matrix( self, apply_tfidf = None, apply_norm = None, dtype = None ):
+		"""
+		Return the document-term matrix, with the default or the specified term weighting and precision applied.
+		"""
+		info = self.get("info")
+		if is_count_corpus( info ):
+			# the default weighted values are stored separately for memory-mapped corpora
+			if self.mmap and not weighting_changed( info, apply_tfidf, apply_norm ):
+				X = load_mmap_matrix( self.in_path, "data" )
+				if dtype is None or X.dtype == np.dtype(dtype):
+					return X
+			return weight_corpus( self.get("counts"), info, apply_tfidf, apply_norm, dtype )
+		if weighting_changed( info, apply_tfidf, apply_norm ):
+			raise ValueError( "Corpus %s does not store raw term counts, so its term weighting cannot be changed" % self.in_path )
+		X = self.get("counts")
+		if dtype is None:
+			return X
+		return X.astype( dtype, copy=False )
+
+	def read( self, field ):
+		if not self.mmap:
+			self.read_joblib( field )
+			if field in self.values:
+				return self.values[field]
+		if field == "classes":
+			labels = self.get("labels")
+			if labels is None:
+				return None
+			return labels_to_classes( labels, self.get("class_names"), self.get("doc_ids") )
+		if not self.mmap:
+			if field in ["labels","class_names"]:
+				(self.values["labels"], self.values["class_names"]) = classes_to_labels( self.values["classes"], self.values["doc_ids"] )
+				return self.values[field]
+			raise ValueError( "Unknown corpus field: %s" % field )
+		if field == "counts":
+			if is_count_corpus( self.get("info") ):
+				return load_mmap_matrix( self.in_path, "counts" )
+			return load_mmap_matrix( self.in_path, "data" )
+		if field == "info":
+			return joblib.load( os.path.join( self.in_path, "info.pkl" ) )
+		field_path = os.path.join( self.in_path, "%s.npy" % field )
+		if field in ["labels","class_names"] and not os.path.exists( field_path ):
+			return None
+		if field == "labels":
+			return np.load( field_path )
+		if field in ["terms","doc_ids","class_names"]:
+			return np.load( field_path ).tolist()
+		raise ValueError( "Unknown corpus field: %s" % field )
 
-def load_corpus( in_path ):
+	def read_joblib( self, field ):
+		"""
+		Read the fields of a corpus stored in a single Joblib file, other than those which have already been read.
+		"""
+		# NB: the matrix arrays are memory-mapped rather than read into memory, unless the matrix is requested
+		corpus = joblib.load( self.in_path, mmap_mode = None if field == "counts" else "r" )
+		if len(corpus) == 6:
+			names = ["counts","terms","doc_ids","labels","class_names","info"]
+		else:
+			# older corpora store a map of class names to sets of document IDs, with or without the info
+			names = ["counts","terms","doc_ids","classes","info"]
+			if len(corpus) == 4:
+				corpus = tuple(corpus) + (None,)
+		for name, value in zip( names, corpus ):
+			if name != "counts" or field == "counts":
+				self.values.setdefault( name, value )
+
+def classes_to_labels( classes, doc_ids ):
+	"""
+	Convert a map of class names to sets of document IDs into an array giving the class index of each document 
+	(-1 for documents without a class), and the sorted list of class names. A document listed under several classes 
+	is given the last of them.
+	"""
+	if classes is None:
+		return (None, None)
+	class_names = sorted( classes.keys() )
+	doc_map = {}
+	for doc_index, doc_id in enumerate(doc_ids):
+		doc_map[doc_id] = doc_index
+	labels = np.full( len(doc_ids), -1, dtype=np.int32 )
+	for class_index, class_name in enumerate(class_names):
+		for doc_id in classes[class_name]:
+			labels[doc_map[doc_id]] = class_index
+	return (labels, class_names)
+
+def labels_to_classes( labels, class_names, doc_ids ):
 	"""
-	Load a pre-processed scikit-learn corpus and associated metadata using Joblib.
+	Convert an array of class indices for each document into a map of class names to sets of document IDs.
 	"""
-	(X,terms,doc_ids,classes) = joblib.load( in_path )
-	return (X, terms, doc_ids, classes)
+	classes = {}
+	for class_name in class_names:
+		classes[class_name] = set()
+	for doc_id, class_index in zip( doc_ids, labels ):
+		if class_index >= 0:
+			classes[class_names[class_index]].add( doc_id )
+	return classes
+
+def weighting_changed( info, apply_tfidf = None, apply_norm = None ):
+	"""
+	Check whether the specified term weighting settings differ from those used when a corpus was parsed.
+	"""
+	for (name, value) in [ ("apply_tfidf", apply_tfidf), ("apply_norm", apply_norm) ]:
+		if not ( value is None or ( not info is None and info["params"][name] == value ) ):
+			return True
+	return False
+
+def is_mmap_corpus( in_path ):
+	"""
+	Check whether the specified path is a corpus stored as a directory of memory-mapped arrays.
+	"""
+	return os.path.isdir( in_path )
+
+def save_mmap_corpus( out_path, X, terms, doc_ids, classes = None, info = None ):
+	"""
+	Save a corpus as a directory, where the arrays of the sparse document-term matrix are stored as raw NumPy files, 
+	so that processes loading the corpus share the same pages in memory. For corpora of raw term counts, both the counts 
+	and the values weighted using the settings chosen when the corpus was parsed are stored. The other fields are also
+	stored in separate files, with the classes stored as an array of class indices.
+	"""
+	if not os.path.exists( out_path ):
+		os.makedirs( out_path )
+	X = sp.csr_matrix( X )
+	X_sorted = X.sorted_indices()
+	arrays = [ ("shape", np.array( X.shape )), ("indices", X_sorted.indices), ("indptr", X_sorted.indptr),
+		("terms", np.array( terms, dtype=str )), ("doc_ids", np.array( doc_ids, dtype=str )) ]
+	if is_count_corpus( info ):
+		# NB: weighting never removes entries, so the weighted matrix has the same sorted indices as the counts
+		arrays.append( ("counts", X_sorted.data) )
+		arrays.append( ("data", weight_corpus( X, info ).sorted_indices().data) )
+	else:
+		arrays.append( ("data", X_sorted.data) )
+	(labels, class_names) = classes_to_labels( classes, doc_ids )
+	if not labels is None:
+		arrays.append( ("labels", labels) )
+		arrays.append( ("class_names", np.array( class_names, dtype=str )) )
+	else:
+		for name in ["labels", "class_names"]:
+			if os.path.exists( os.path.join( out_path, "%s.npy" % name ) ):
+				os.remove( os.path.join( out_path, "%s.npy" % name ) )
+	# write new files and then replace the old ones, so that any existing memory maps remain valid
+	for (name, values) in arrays:
+		array_path = os.path.join( out_path, "%s.npy" % name )
+		with open( array_path + ".tmp", "wb" ) as fout:
+			np.save( fout, values )
+		os.replace( array_path + ".tmp", array_path )
+	info_path = os.path.join( out_path, "info.pkl" )
+	joblib.dump( info, info_path + ".tmp" )
+	os.replace( info_path + ".tmp", info_path )
+
+def load_mmap_matrix( in_path, values = "data" ):
+	"""
+	Open the sparse document-term matrix of a memory-mapped corpus in read-only mode, using the specified array of values.
+	"""
+	shape = tuple( np.load( os.path.join( in_path, "shape.npy" ) ) )
+	arrays = []
+	for name in [ values, "indices", "indptr" ]:
+		arrays.append( np.load( os.path.join( in_path, "%s.npy" % name ), mmap_mode="r" ) )
+	return sp.csr_matrix( tuple(arrays), shape=shape, copy=False )
+
+def append_corpus( X, doc_ids, classes, X_new, new_doc_ids, new_classes = None ):
+	"""
+	Append the rows of a new document-term matrix to an existing corpus, merging the document IDs and any ground truth classes.
+	"""
+	X = sp.vstack( [X, X_new], format="csr" )
+	doc_ids = list(doc_ids) + list(new_doc_ids)
+	if not (classes is None or new_classes is None):
+		merged_classes = {}
+		for label in classes:
+			merged_classes[label] = set( classes[label] )
+		for label in new_classes:
+			merged_classes.setdefault( label, set() ).update( new_classes[label] )
+		classes = merged_classes
+	return (X, doc_ids, classes)
 
 def find_documents( root_path ):
 	"""
@@ -140,23 +899,256 @@ def find_documents( root_path ):
 	filepaths.sort()
 	return filepaths	
 
+def is_archive( in_path ):
+	"""
+	Check whether the specified path is a zip or tar archive of documents.
+	"""
+	lower_path = in_path.lower()
+	for ext in archive_extensions:
+		if lower_path.endswith( ext ):
+			return os.path.isfile( in_path )
+	return False
+
+def iter_archive( archive_path ):
+	"""
+	Iterate over the document files stored in a zip or tar archive, in the order in which they are stored. For each
+	file, yields its path (i.e. the member path joined to the archive path), a key identifying the version of its 
+	contents, and a function which reads its contents. Files are filtered in the same way as find_documents().
+	"""
+	if archive_path.lower().endswith(".zip"):
+		with zipfile.ZipFile( archive_path ) as archive:
+			for info in archive.infolist():
+				filename = os.path.basename( info.filename )
+				if info.is_dir() or filename.startswith(".") or filename.startswith("_"):
+					continue
+				yield ( os.path.join( archive_path, info.filename ), ( info.file_size, info.CRC ), lambda info=info: archive.read(info) )
+	else:
+		# NB: read the tar file as a stream, so that compressed archives are only decompressed once
+		with tarfile.open( archive_path, "r|*" ) as archive:
+			for info in archive:
+				filename = os.path.basename( info.name )
+				if not info.isfile() or filename.startswith(".") or filename.startswith("_"):
+					continue
+				yield ( os.path.join( archive_path, info.name ), ( info.size, int(info.mtime) ), lambda info=info: archive.extractfile(info).read() )
+
+def count_archive_entries( entries, analyzer ):
+	"""
+	Normalize and tokenize a list of (path, key, data) archive entries, returning the path, key, text length and term 
+	counts for each one. Entries without data are returned with None in place of the length and counts.
+	"""
+	results = []
+	for (path, key, data) in entries:
+		if data is None:
+			results.append( (path, key, None, None) )
+		else:
+			body = normalize_data( data )
+			results.append( (path, key, len(body), count_document_terms( body, analyzer )) )
+	return results
+
+def read_archive_term_counts( archive_path, params, cache = None, jobs = 1, include = None, batch_size = 100 ):
+	"""
+	Read, normalize and tokenize the documents stored in a zip or tar archive without extracting them, yielding 
+	the path, text length and term counts for each document in the order in which they are stored. An optional
+	function can be specified to select which paths are included. If a token cache is specified, only new or modified 
+	documents are tokenized. If jobs is not 1, the documents are tokenized by a pool of worker processes.
+	"""
+	def generate_entries():
+		for (path, key, read) in iter_archive( archive_path ):
+			if not ( include is None or include( path ) ):
+				continue
+			if ( not cache is None ) and cache.contains( path, key ):
+				yield ( path, key, None )
+			else:
+				yield ( path, key, read() )
+	if jobs == 1:
+		analyzer = build_analyzer( params )
+		results = ( count_archive_entries( batch, analyzer ) for batch in iter_chunks( generate_entries(), batch_size ) )
+		pool = None
+	else:
+		if jobs < 1:
+			jobs = multiprocessing.cpu_count()
+		pool = multiprocessing.Pool( jobs, init_worker, (params,) )
+		results = merge_worker_counts( imap_bounded( pool, count_archive_batch, iter_chunks( generate_entries(), batch_size ), 2 * jobs ), params["tokenizer"] )
+	try:
+		for batch_results in results:
+			for (path, key, length, counts) in batch_results:
+				if length is None:
+					(length, counts) = cache.get( path )
+				elif not cache is None:
+					cache.put( path, key, length, counts )
+				yield ( path, length, counts )
+		if not pool is None:
+			pool.close()
+	finally:
+		if not pool is None:
+			pool.terminate()
+			pool.join()
+
+def open_text( in_path ):
+	"""
+	Open a UTF-8 text file for reading, which may be compressed with gzip (.gz), bzip2 (.bz2) or xz (.xz). 
+	A path of "-" indicates that standard input should be read.
+	"""
+	ext = os.path.splitext( in_path )[1].lower()
+	if in_path == "-":
+		fin = sys.stdin.buffer
+	elif ext == ".gz":
+		fin = gzip.open( in_path, "rb" )
+	elif ext == ".bz2":
+		fin = bz2.open( in_path, "rb" )
+	elif ext in [".xz", ".lzma"]:
+		fin = lzma.open( in_path, "rb" )
+	else:
+		return codecs.open( in_path, 'r', encoding="utf8", errors='ignore' )
+	return codecs.getreader("utf8")( fin, errors='ignore' )
+
+def read_lines( in_path ):
+	"""
+	Read the lines from the specified text file one at a time, stripping any surrounding whitespace.
+	"""
+	with open_text( in_path ) as fin:
+		for line in fin:
+			yield line.strip()
+
 def read_text( in_path ):
 	"""
 	Read and normalize body text from the specified document file.
 	"""
-	http_re = re.compile('https?[:;]?/?/?\S*')
 	# read the file
 	f = codecs.open(in_path, 'r', encoding="utf8", errors='ignore')
+	body = normalize_lines( iter( f.readline, "" ) )
+	f.close()	
+	return body
+
+def normalize_lines( lines ):
+	"""
+	Normalize the lines of body text from a document, removing URIs and very short lines.
+	"""
 	body = ""
-	while True:
-		line = f.readline()
-		if not line:
-			break
+	for line in lines:
 		# Remove URIs at this point (Note: this simple regex captures MOST URIs but may occasionally let others slip through)
 		normalized_line = re.sub(http_re, '', line.strip())
 		if len(normalized_line) > 1:
 			body += normalized_line
 			body += "\n"
-	f.close()	
 	return body
-	
+
+def normalize_data( data ):
+	"""
+	Decode and normalize body text from the raw UTF-8 contents of a document.
+	"""
+	return normalize_lines( data.decode( "utf8", "ignore" ).splitlines( True ) )
+
+# --------------------------------------------------------------
+# Token Cache
+# --------------------------------------------------------------
+
+class TokenCache:
+	"""
+	On-disk cache of the term counts for individual document files, stored in a SQLite database. Entries are keyed by
+	file path, size and modification time, so that only new or changed files need to be read and tokenized again. The 
+	cache is tied to the tokenizer, stopwords and n-gram settings, and is cleared if these change.
+	"""
+	def __init__( self, db_path, params, commit_every = 1000 ):
+		self.db_path = db_path
+		self.commit_every = commit_every
+		self.pending = 0
+		self.hits = 0
+		self.misses = 0
+		self.db = sqlite3.connect( db_path )
+		self.db.execute( "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)" )
+		self.db.execute( "CREATE TABLE IF NOT EXISTS docs (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, length INTEGER, counts BLOB)" )
+		# NB: the term counts do not depend on min_df or the term weighting, so these are not part of the signature
+		tokenizer = params["tokenizer"]
+		signature = hashlib.sha1( pickle.dumps( ( tokenizer.__class__.__name__, sorted(tokenizer.get_params().items()), params["stopwords"], tuple(params["ngram_range"]) ), protocol = 2 ) ).hexdigest()
+		row = self.db.execute( "SELECT value FROM meta WHERE name='signature'" ).fetchone()
+		if row is None or row[0] != signature:
+			self.db.execute( "DELETE FROM docs" )
+			self.db.execute( "INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,) )
+		self.db.commit()
+
+	def file_key( self, in_path ):
+		"""
+		Return the size and modification time of the specified file, which are used to detect changes.
+		"""
+		st = os.stat( in_path )
+		return ( st.st_size, st.st_mtime_ns )
+
+	def contains( self, in_path, key ):
+		"""
+		Check whether up-to-date term counts are cached for the specified file.
+		"""
+		row = self.db.execute( "SELECT size, mtime FROM docs WHERE path=?", (os.path.abspath(in_path),) ).fetchone()
+		return ( not row is None ) and tuple(row) == key
+
+	def get( self, in_path ):
+		"""
+		Return the text length and term counts cached for the specified file.
+		"""
+		row = self.db.execute( "SELECT length, counts FROM docs WHERE path=?", (os.path.abspath(in_path),) ).fetchone()
+		self.hits += 1
+		return ( row[0], pickle.loads( row[1] ) )
+
+	def put( self, in_path, key, length, counts ):
+		"""
+		Store the text length and term counts for the specified file.
+		"""
+		self.db.execute( "INSERT OR REPLACE INTO docs VALUES (?,?,?,?,?)", (os.path.abspath(in_path), key[0], key[1], length, pickle.dumps( counts, protocol = pickle.HIGHEST_PROTOCOL )) )
+		self.misses += 1
+		self.pending += 1
+		if self.pending >= self.commit_every:
+			self.db.commit()
+			self.pending = 0
+
+	def close( self ):
+		self.db.commit()
+		self.db.close()
+
+def read_term_counts( filepaths, params, cache = None, jobs = 1 ):
+	"""
+	Read, normalize and tokenize the specified document files, yielding the text length and term counts for each file
+	in the same order as the file paths. If a token cache is specified, only new or modified files are read and tokenized.
+	If jobs is not 1, the files are read and tokenized by a pool of worker processes.
+	"""
+	if cache is None:
+		missing_paths = filepaths
+	else:
+		# find the files which need to be read
+		keys = [cache.file_key( in_path ) for in_path in filepaths]
+		missing = [not cache.contains( in_path, key ) for in_path, key in zip(filepaths, keys)]
+		missing_paths = [in_path for in_path, is_missing in zip(filepaths, missing) if is_missing]
+	if jobs == 1:
+		analyzer = build_analyzer( params )
+		results = ( ( len(body), count_document_terms( body, analyzer ) ) for body in map( read_text, missing_paths ) )
+		pool = None
+	else:
+		if jobs < 1:
+			jobs = multiprocessing.cpu_count()
+		pool = multiprocessing.Pool( jobs, init_worker, (params,) )
+		results = merge_worker_counts( pool.imap( read_and_count, missing_paths, 50 ), params["tokenizer"] )
+	try:
+		if cache is None:
+			for result in results:
+				yield result
+		else:
+			for in_path, key, is_missing in zip(filepaths, keys, missing):
+				if is_missing:
+					(length, counts) = next( results )
+					cache.put( in_path, key, length, counts )
+					yield ( length, counts )
+				else:
+					yield cache.get( in_path )
+		if not pool is None:
+			pool.close()
+	finally:
+		if not pool is None:
+			pool.terminate()
+			pool.join()
+
+def merge_worker_counts( results, tokenizer ):
+	"""
+	Yield the counting results returned by worker processes, merging any memo table updates into the specified tokenizer.
+	"""
+	for (result, updates) in results:
+		merge_memo_updates( tokenizer, updates )
+		yield result
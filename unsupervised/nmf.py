@@ -1,18 +1,107 @@
+import copy, hashlib, os, time, warnings
 import numpy as np
+import scipy.sparse
 from sklearn import decomposition
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.utils.extmath import randomized_svd
 import logging as log
 
 # --------------------------------------------------------------
 
+class TermStability:
+	"""
+	Stopping criterion for NMF runs, based on the stability of the top terms of each topic. Every few iterations, the
+	set of top terms for each topic in the H factor is compared with the previous check, and the run is stopped once the
+	sets are unchanged for the specified number of consecutive checks. The relative decrease in reconstruction error at
+	each check is also recorded, to estimate how many iterations were saved compared with stopping by tolerance.
+	"""
+	def __init__( self, top = 10, patience = 3, every = 5 ):
+		self.top = top
+		self.patience = patience
+		self.every = every
+		self.reset()
+
+	def reset( self ):
+		self.previous = None
+		self.unchanged = 0
+		self.decreases = []
+
+	def check( self, H, n_iter, decrease = None ):
+		"""
+		Check the topics after the specified iteration, returning True if the run should stop. The decrease is the 
+		relative decrease in reconstruction error which the run compares with its tolerance, if available.
+		"""
+		if n_iter % self.every != 0:
+			return False
+		if not decrease is None:
+			self.decreases.append( ( n_iter, decrease ) )
+		top = min( self.top, H.shape[1] )
+		# NB: the order of terms within the top terms is ignored
+		top_sets = np.sort( np.argpartition( -H, top - 1, axis = 1 )[:, :top], axis = 1 )
+		if not self.previous is None and np.array_equal( top_sets, self.previous ):
+			self.unchanged += 1
+		else:
+			self.unchanged = 0
+		self.previous = top_sets
+		return self.unchanged >= self.patience
+
+	def iters_to_tol( self, tol, n_iter, max_iters ):
+		"""
+		Estimate how many more iterations a run stopped after n_iter iterations would have needed before its relative 
+		decrease in error fell below tol, assuming that the decrease keeps shrinking at the rate seen between the last 
+		two checks. Returns 0 if the decrease was not shrinking, so that no saving is claimed.
+		"""
+		if tol <= 0:
+			return max_iters - n_iter
+		if len(self.decreases) < 2:
+			return 0
+		(n_iter1, decrease1), (n_iter2, decrease2) = self.decreases[-2:]
+		if decrease2 <= tol or decrease2 >= decrease1:
+			return 0
+		rate = np.log( decrease2 / decrease1 ) / ( n_iter2 - n_iter1 )
+		return int( min( np.ceil( np.log( tol / decrease2 ) / rate ), max_iters - n_iter ) )
+
+def stopping_stats( stats, stable, stability ):
+	"""
+	Add the reason why a run stopped to its statistics, and the estimated number of iterations saved compared with 
+	stopping by tolerance, if it was stopped early due to the stability of its top terms.
+	"""
+	stats["stopped_on_stability"] = stable
+	stats["iters_saved"] = stability.iters_to_tol( stats["tol"], stats["n_iter"], stats["max_iters"] ) if stable else 0
+	return stats
+
+def rank_top_terms( H, top = -1 ):
+	"""
+	Return an array with the indices of the top ranked terms for every topic in the H factor, one row per topic. If top
+	is less than 1, all terms are ranked. Otherwise only the top terms are found and sorted, using a partial sort.
+	"""
+	n_terms = H.shape[1]
+	if top < 1 or top >= n_terms:
+		# NB: reverse, so that ties are ranked in the same order as before
+		return np.argsort( H, axis = 1 )[:, ::-1]
+	rows = np.arange( H.shape[0] )[:, np.newaxis]
+	top_indices = np.argpartition( -H, top - 1, axis = 1 )[:, :top]
+	order = np.argsort( H[rows, top_indices], axis = 1 )[:, ::-1]
+	return top_indices[rows, order]
+
+# --------------------------------------------------------------
+
 class SklNMF:
 	"""
-	Wrapper class backed by the scikit-learn package NMF implementation.
+	Wrapper class backed by the scikit-learn package NMF implementation. After each run, the stats dictionary records 
+	the number of iterations used, the final reconstruction error, whether the run converged and the elapsed time.
+	If a term stability criterion is specified, the scikit-learn implementation is applied for a few iterations at a
+	time, continuing from the previous factors, until the top terms are stable or the decrease in reconstruction error
+	between stages, relative to the error after the first stage, falls below tol.
 	"""
-	def __init__( self, max_iters = 100, init_strategy = "random" ):
-		self.max_iters = 100
+	def __init__( self, max_iters = 100, init_strategy = "random", tol = 1e-4, stability = None ):
+		self.max_iters = max_iters
 		self.init_strategy = init_strategy
+		self.tol = tol
+		self.stability = stability
 		self.W = None
 		self.H = None
+		self.stats = None
 
 	def apply( self, X, k = 2, init_W = None, init_H = None ):
 		"""
@@ -20,14 +109,80 @@ class SklNMF:
 		"""
 		self.W = None
 		self.H = None
+		self.stats = None
 		random_seed = np.random.randint( 1, 100000 )
-		if not (init_W is None or init_H is None):
-			model = decomposition.NMF( init="custom", n_components=k, max_iter=self.max_iters, random_state = random_seed )
-			self.W = model.fit_transform( X, W=init_W, H=init_H )
+		start = time.time()
+		if self.stability is None:
+			# NB: scikit-learn only reports whether a run converged by warning when it did not
+			with warnings.catch_warnings( record = True ) as caught:
+				warnings.simplefilter( "always", ConvergenceWarning )
+				if not (init_W is None or init_H is None):
+					init = "custom"
+					model = decomposition.NMF( init=init, n_components=k, max_iter=self.max_iters, tol=self.tol, random_state = random_seed )
+					self.W = model.fit_transform( X, W=init_W, H=init_H )
+				else:
+					init = self.init_strategy
+					model = decomposition.NMF( init=init, n_components=k, max_iter=self.max_iters, tol=self.tol, random_state = random_seed )
+					self.W = model.fit_transform( X )
+			for w in caught:
+				warnings.warn_explicit( w.message, w.category, w.filename, w.lineno )
+			self.H = model.components_			
+			n_iter, stable = model.n_iter_, False
+			converged = not any( issubclass( w.category, ConvergenceWarning ) for w in caught )
 		else:
-			model = decomposition.NMF( init=self.init_strategy, n_components=k, max_iter=self.max_iters, random_state = random_seed )
-			self.W = model.fit_transform( X )
-		self.H = model.components_			
+			init = self.init_strategy if (init_W is None or init_H is None) else "custom"
+			(model, n_iter, converged, stable) = self.apply_stages( X, k, init_W, init_H, random_seed )
+		# NB: keep the factors in the same precision as the input matrix
+		self.W = self.W.astype( X.dtype, copy=False )
+		self.H = self.H.astype( X.dtype, copy=False )
+		self.stats = { "engine" : "sklearn", "k" : k, "init" : init, "max_iters" : self.max_iters, "tol" : self.tol, "n_iter" : int( n_iter ),
+			"converged" : bool( converged ), "reconstruction_err" : float( model.reconstruction_err_ ),
+			"elapsed" : round( time.time() - start, 4 ), "n_rows" : X.shape[0], "n_cols" : X.shape[1], "dtype" : str( X.dtype ),
+			"nnz" : int( X.nnz if scipy.sparse.issparse( X ) else np.count_nonzero( X ) ) }
+		if not self.stability is None:
+			stopping_stats( self.stats, stable, self.stability )
+
+	def apply_stages( self, X, k, init_W, init_H, random_seed ):
+		"""
+		Apply NMF in stages of a few iterations, checking the stability of the top terms after each stage. Since 
+		scikit-learn measures its tolerance from the start of each fit, convergence is instead checked between stages:
+		the run stops once the decrease in reconstruction error over a stage, relative to the error after the first
+		stage, falls below tol. So the same tol can stop a run at a different point than a single scikit-learn fit.
+		Returns the last model, the total number of iterations, whether the run converged, and whether it was stopped 
+		due to stability.
+		"""
+		self.stability.reset()
+		init, W, H = "custom", init_W, init_H
+		if init_W is None or init_H is None:
+			init = self.init_strategy
+		n_iter, first_stage_error, previous_error = 0, None, None
+		with warnings.catch_warnings():
+			# NB: each stage stops at its iteration limit
+			warnings.simplefilter( "ignore", ConvergenceWarning )
+			while n_iter < self.max_iters:
+				stage_iters = min( self.stability.every, self.max_iters - n_iter )
+				model = decomposition.NMF( init=init, n_components=k, max_iter=stage_iters, tol=self.tol, random_state = random_seed )
+				if init == "custom":
+					W = model.fit_transform( X, W=W, H=H )
+				else:
+					W = model.fit_transform( X )
+				H = model.components_
+				init = "custom"
+				n_iter += model.n_iter_
+				self.W, self.H = W, H
+				if model.n_iter_ < stage_iters:
+					return ( model, n_iter, True, False )
+				error, decrease = model.reconstruction_err_, None
+				if first_stage_error is None:
+					first_stage_error = error
+				elif first_stage_error > 0:
+					decrease = ( previous_error - error ) / first_stage_error
+					if decrease < self.tol:
+						return ( model, n_iter, True, False )
+				previous_error = error
+				if self.stability.check( H, n_iter, decrease ) and n_iter < self.max_iters:
+					return ( model, n_iter, False, True )
+		return ( model, n_iter, False, False )
 		
 	def rank_terms( self, topic_index, top = -1 ):
 		"""
@@ -35,12 +190,15 @@ class SklNMF:
 		"""
 		if self.H is None:
 			raise ValueError("No results for previous run available")
-		# NB: reverse
-		top_indices = np.argsort( self.H[topic_index,:] )[::-1]
-		# truncate if necessary
-		if top < 1 or top > len(top_indices):
-			return top_indices
-		return top_indices[0:top]
+		return rank_top_terms( self.H[topic_index:topic_index+1,:], top )[0]
+
+	def rank_all_terms( self, top = -1 ):
+		"""
+		Return the top ranked terms for all topics generated during the last NMF run, as an array with one row per topic.
+		"""
+		if self.H is None:
+			raise ValueError("No results for previous run available")
+		return rank_top_terms( self.H, top )
 
 	def generate_partition( self ):
 		if self.W is None:
@@ -49,3 +207,472 @@ class SklNMF:
 
 
 
+
+# --------------------------------------------------------------
+
+def nndsvd( X, k, random_state = None, eps = 1e-6 ):
+	"""
+	Create initial W and H factors for the specified matrix X using Non-negative Double Singular Value Decomposition 
+	(NNDSVD), based on a randomized truncated SVD of X.
+	"""
+	U, S, V = randomized_svd( X, k, random_state = random_state )
+	return nndsvd_from_svd( U, S, V, eps )
+
+def nndsvd_from_svd( U, S, V, eps = 1e-6 ):
+	"""
+	Create NNDSVD initial W and H factors from a truncated SVD U S V, with one component for each singular value.
+	"""
+	k = len(S)
+	W, H = np.zeros( ( U.shape[0], k ) ), np.zeros( ( k, V.shape[1] ) )
+	# the leading singular vectors can be chosen to be non-negative
+	W[:, 0] = np.sqrt( S[0] ) * np.abs( U[:, 0] )
+	H[0, :] = np.sqrt( S[0] ) * np.abs( V[0, :] )
+	for j in range( 1, k ):
+		x, y = U[:, j], V[j, :]
+		# use the positive or negative parts of the pair of singular vectors, whichever has the larger norm
+		x_p, y_p = np.maximum( x, 0 ), np.maximum( y, 0 )
+		x_n, y_n = np.abs( np.minimum( x, 0 ) ), np.abs( np.minimum( y, 0 ) )
+		x_p_nrm, y_p_nrm = np.linalg.norm( x_p ), np.linalg.norm( y_p )
+		x_n_nrm, y_n_nrm = np.linalg.norm( x_n ), np.linalg.norm( y_n )
+		m_p, m_n = x_p_nrm * y_p_nrm, x_n_nrm * y_n_nrm
+		if max( m_p, m_n ) == 0:
+			continue
+		if m_p > m_n:
+			u, v, sigma = x_p / x_p_nrm, y_p / y_p_nrm, m_p
+		else:
+			u, v, sigma = x_n / x_n_nrm, y_n / y_n_nrm, m_n
+		lbd = np.sqrt( S[j] * sigma )
+		W[:, j] = lbd * u
+		H[j, :] = lbd * v
+	W[W < eps] = 0
+	H[H < eps] = 0
+	return ( W, H )
+
+def warm_start_factors( W, H, k, random_state = None ):
+	"""
+	Create initial factors with k components from the factors of a run with a different number of components. To add
+	components, the components with the largest weights are each split into two perturbed copies, and any further 
+	components are initialized with small random values. To remove components, those with the largest weights are kept.
+	"""
+	if random_state is None:
+		random_state = np.random.RandomState( np.random.randint( 1, 100000 ) )
+	k_prev = H.shape[0]
+	weights = np.linalg.norm( W, axis = 0 ) * np.linalg.norm( H, axis = 1 )
+	order = np.argsort( weights )[::-1]
+	if k <= k_prev:
+		keep = np.sort( order[0:k] )
+		return ( np.array( W[:, keep] ), np.array( H[keep, :] ) )
+	W, H = np.array( W, dtype = np.float64 ), np.array( H, dtype = np.float64 )
+	new_W, new_H = [], []
+	for i in range( k - k_prev ):
+		if i < k_prev:
+			# split the component, so that the sum of the two copies is unchanged
+			j = order[i]
+			noise = random_state.uniform( 0, 0.5, H.shape[1] )
+			W[:, j] /= 2
+			new_W.append( W[:, j].copy() )
+			new_H.append( H[j, :] * ( 1 - noise ) )
+			H[j, :] *= ( 1 + noise )
+		else:
+			new_W.append( W.mean() * np.abs( random_state.randn( W.shape[0] ) ) )
+			new_H.append( H.mean() * np.abs( random_state.randn( H.shape[1] ) ) )
+	return ( np.column_stack( [W] + new_W ), np.vstack( [H] + new_H ) )
+
+def matrix_hash( X ):
+	"""
+	Calculate an MD5 hash of the shape, precision and values of a sparse or dense matrix.
+	"""
+	checksum = hashlib.md5( ( "%s %s" % ( X.shape, X.dtype ) ).encode("ascii") )
+	if scipy.sparse.issparse( X ):
+		X = X.tocsr()
+		arrays = [X.indptr, X.indices, X.data]
+	else:
+		arrays = [X]
+	for a in arrays:
+		checksum.update( np.ascontiguousarray( a ).data )
+	return checksum.hexdigest()
+
+class SVDCache:
+	"""
+	Cache of the truncated SVDs of document-term matrices, used to create NNDSVD initializations without recomputing
+	the SVD. Each SVD is kept in memory and, if a cache directory is specified, stored in a file keyed by a hash of the 
+	matrix and the number of components. The initializations for a subset of the documents (e.g. a k-fold sample) are 
+	derived from the SVD of the full matrix, by restricting the left singular vectors to the rows of the subset.
+	"""
+	def __init__( self, cache_dir = None ):
+		self.cache_dir = cache_dir
+		self.svds = {}
+		self.last_key = None
+		self.hits = 0
+		self.misses = 0
+
+	def svd( self, X, k ):
+		"""
+		Return the rank k truncated SVD U S V of the specified matrix, calculating it only if it is not already cached.
+		"""
+		# NB: avoid hashing the same matrix again on consecutive calls
+		if not self.last_key is None and self.last_key[0] is X:
+			key = "%s_k%02d" % ( self.last_key[1], k )
+		else:
+			matrix_key = matrix_hash( X )
+			self.last_key = ( X, matrix_key )
+			key = "%s_k%02d" % ( matrix_key, k )
+		if key in self.svds:
+			self.hits += 1
+			return self.svds[key]
+		cache_path = None if self.cache_dir is None else os.path.join( self.cache_dir, "svd_%s.npz" % key )
+		if not cache_path is None and os.path.exists( cache_path ):
+			log.debug( "Reading cached SVD from %s" % cache_path )
+			self.hits += 1
+			with np.load( cache_path ) as arrays:
+				svd = ( arrays["U"], arrays["S"], arrays["V"] )
+		else:
+			self.misses += 1
+			svd = randomized_svd( X, k, random_state = 0 )
+			if not cache_path is None:
+				if not os.path.exists( self.cache_dir ):
+					os.makedirs( self.cache_dir )
+				log.debug( "Writing SVD to cache %s" % cache_path )
+				np.savez( cache_path, U = svd[0], S = svd[1], V = svd[2] )
+		self.svds[key] = svd
+		return svd
+
+	def nndsvd( self, X, k, rows = None ):
+		"""
+		Create NNDSVD initial W and H factors for the specified matrix, or for the subset of its rows with the specified 
+		indices, in the same precision as the matrix.
+		"""
+		U, S, V = self.svd( X, k )
+		if not rows is None:
+			U = U[rows]
+		W, H = nndsvd_from_svd( U, S, V )
+		return ( W.astype( X.dtype ), H.astype( X.dtype ) )
+
+def update_hals( F, XG, GtG, eps = 1e-10 ):
+	"""
+	Update the columns of the factor F in place, one at a time, given the products of the matrix and fixed factor G.
+	"""
+	for j in range( F.shape[1] ):
+		if GtG[j, j] <= 0:
+			continue
+		F[:, j] += ( XG[:, j] - F.dot( GtG[:, j] ) ) / GtG[j, j]
+		np.maximum( F[:, j], eps, out = F[:, j] )
+
+def update_mu( F, XG, GtG, eps = 1e-10 ):
+	"""
+	Update the factor F in place with the multiplicative update rule, given the products of the matrix and fixed factor G.
+	"""
+	F *= XG / ( F.dot( GtG ) + eps )
+
+# update rules used by the native and online implementations
+update_rules = { "hals" : update_hals, "mu" : update_mu }
+
+def stack_factors( factors, axis ):
+	"""
+	Stack the factors of several runs, avoiding a copy when there is only a single factor.
+	"""
+	if len(factors) == 1:
+		return factors[0]
+	return np.concatenate( factors, axis = axis )
+
+class NativeNMF:
+	"""
+	NMF implementation which applies Hierarchical Alternating Least Squares (HALS) or multiplicative updates (MU) directly
+	to a sparse CSR or dense matrix with NumPy, keeping the factors in the same precision as the matrix. The runs stop
+	after max_iters iterations, or once the relative decrease in reconstruction error in an iteration falls below tol.
+	"""
+	def __init__( self, max_iters = 100, init_strategy = "random", tol = 1e-4, update = "hals", stability = None ):
+		if not update in update_rules:
+			raise ValueError( "Unknown NMF update rule: %s" % update )
+		self.max_iters = max_iters
+		self.init_strategy = init_strategy
+		self.tol = tol
+		self.update = update
+		self.stability = stability
+		self.W = None
+		self.H = None
+		self.stats = None
+		self.runs = []
+
+	def initialize( self, X, k, random_state ):
+		"""
+		Create the initial factors for a run, using random values scaled to the mean of X, or NNDSVD.
+		"""
+		if self.init_strategy == "nndsvd":
+			return nndsvd( X, k, random_state = random_state )
+		avg = np.sqrt( X.mean() / k )
+		H = avg * random_state.randn( k, X.shape[1] )
+		W = avg * random_state.randn( X.shape[0], k )
+		return ( np.abs( W ), np.abs( H ) )
+
+	def apply( self, X, k = 2, init_W = None, init_H = None ):
+		"""
+		Apply NMF to the specified document-term matrix X.
+		"""
+		if not (init_W is None or init_H is None):
+			self.apply_batch( X, k, 1, inits = [( init_W, init_H )] )
+		else:
+			self.apply_batch( X, k, 1 )
+		self.select( 0 )
+
+	def apply_batch( self, X, k = 2, n_runs = 2, inits = None ):
+		"""
+		Apply NMF to the specified document-term matrix X for several runs at once, each with its own initialization. 
+		The factors of the runs are stacked, so that each pass over X calculates the products for all of the runs which
+		have not yet converged. The results are stored in the runs list, and can be selected with select().
+		"""
+		self.W = None
+		self.H = None
+		self.stats = None
+		self.runs = []
+		start = time.time()
+		Ws, Hs = [], []
+		for i in range( n_runs ):
+			if inits is None:
+				random_state = np.random.RandomState( np.random.randint( 1, 100000 ) )
+				W, H = self.initialize( X, k, random_state )
+			else:
+				W, H = np.array( inits[i][0] ), np.array( inits[i][1] )
+			if self.update == "mu":
+				# multiplicative updates cannot change zero entries, so fill them with small values
+				avg = X.mean()
+				W[W == 0], H[H == 0] = avg / 100, avg / 100
+			Ws.append( np.asfortranarray( W, dtype = X.dtype ) )
+			Hs.append( np.ascontiguousarray( H, dtype = X.dtype ) )
+		# the transpose is used to calculate X^T W on each iteration
+		if scipy.sparse.issparse( X ):
+			X, XT = X.tocsr(), X.T.tocsr()
+			norm_X = np.dot( X.data, X.data )
+		else:
+			XT = X.T
+			norm_X = np.sum( X * X )
+		update = update_rules[self.update]
+		n_iters, errors = [0] * n_runs, [None] * n_runs
+		errors_at_init, previous_errors = [None] * n_runs, [None] * n_runs
+		stabilities, stable, tol_converged = [None] * n_runs, [False] * n_runs, [False] * n_runs
+		if not self.stability is None:
+			stabilities = [copy.copy( self.stability ) for i in range( n_runs )]
+			for stability in stabilities:
+				stability.reset()
+		active = list( range( n_runs ) )
+		for n_iter in range( 1, self.max_iters + 1 ):
+			# update H using (X^T W)^T and W^T W, with a single product for the W factors of all active runs
+			XTW = np.asarray( XT.dot( stack_factors( [Ws[i] for i in active], axis = 1 ) ) )
+			for b, i in enumerate( active ):
+				update( Hs[i].T, XTW[:, b*k:(b+1)*k], Ws[i].T.dot( Ws[i] ) )
+			# update W using X H^T and H H^T, also used to calculate the error of the current factors
+			XHt = np.asarray( X.dot( stack_factors( [Hs[i] for i in active], axis = 0 ).T ) )
+			stopped = set()
+			for b, i in enumerate( active ):
+				XHt_i, HHt = XHt[:, b*k:(b+1)*k], Hs[i].dot( Hs[i].T )
+				errors[i] = np.sqrt( max( norm_X - 2 * np.sum( Ws[i] * XHt_i ) + np.sum( Ws[i].T.dot( Ws[i] ) * HHt ), 0 ) )
+				update( Ws[i], XHt_i, HHt )
+				n_iters[i] = n_iter
+				decrease = None
+				if errors_at_init[i] is None:
+					errors_at_init[i] = errors[i]
+				elif errors_at_init[i] > 0:
+					decrease = ( previous_errors[i] - errors[i] ) / errors_at_init[i]
+					if decrease < self.tol:
+						tol_converged[i] = True
+						stopped.add( i )
+				if not ( stabilities[i] is None or i in stopped ) and stabilities[i].check( Hs[i], n_iter, decrease ) and n_iter < self.max_iters:
+					stable[i] = True
+					stopped.add( i )
+				previous_errors[i] = errors[i]
+			active = [i for i in active if not i in stopped]
+			if len(active) == 0:
+				break
+		# NB: the elapsed time of a batch is shared between its runs
+		elapsed = round( ( time.time() - start ) / n_runs, 4 )
+		init = self.init_strategy if inits is None else "custom"
+		for i in range( n_runs ):
+			stats = { "engine" : self.update, "k" : k, "init" : init, "max_iters" : self.max_iters, "tol" : self.tol, "n_iter" : n_iters[i],
+				"converged" : tol_converged[i], "reconstruction_err" : float( errors[i] ),
+				"elapsed" : elapsed, "n_rows" : X.shape[0], "n_cols" : X.shape[1], "dtype" : str( X.dtype ),
+				"nnz" : int( X.nnz if scipy.sparse.issparse( X ) else np.count_nonzero( X ) ) }
+			if n_runs > 1:
+				stats["batch"] = n_runs
+			if not self.stability is None:
+				stopping_stats( stats, stable[i], stabilities[i] )
+			self.runs.append( ( Ws[i], Hs[i], stats ) )
+
+	def select( self, run_index ):
+		"""
+		Select the results of one of the runs from the last batch, for use by rank_terms() and generate_partition().
+		"""
+		(self.W, self.H, self.stats) = self.runs[run_index]
+
+	def rank_terms( self, topic_index, top = -1 ):
+		"""
+		Return the top ranked terms for the specified topic, generated during the last NMF run.
+		"""
+		if self.H is None:
+			raise ValueError("No results for previous run available")
+		return rank_top_terms( self.H[topic_index:topic_index+1,:], top )[0]
+
+	def rank_all_terms( self, top = -1 ):
+		"""
+		Return the top ranked terms for all topics generated during the last NMF run, as an array with one row per topic.
+		"""
+		if self.H is None:
+			raise ValueError("No results for previous run available")
+		return rank_top_terms( self.H, top )
+
+	def generate_partition( self ):
+		if self.W is None:
+			raise ValueError("No results for previous run available")
+		return np.argmax( self.W, axis = 1 ).flatten().tolist()
+
+# --------------------------------------------------------------
+
+class OnlineNMF:
+	"""
+	Online NMF implementation, which streams chunks of rows from the document-term matrix (e.g. a memory-mapped corpus)
+	rather than requiring the whole matrix in memory. For each chunk, the document factor W is recovered by folding the 
+	documents into the current topics, and the topic factor H is then updated from running statistics of the chunks seen 
+	so far. Each iteration is a pass over the matrix, and the runs stop after max_iters passes, or once the relative 
+	decrease in reconstruction error in a pass falls below tol.
+	"""
+	def __init__( self, max_iters = 100, init_strategy = "random", tol = 1e-4, update = "hals", stability = None, chunk_size = 10000, forget_factor = 0.7, fold_in_iters = 10 ):
+		if not update in update_rules:
+			raise ValueError( "Unknown NMF update rule: %s" % update )
+		self.max_iters = max_iters
+		self.init_strategy = init_strategy
+		self.tol = tol
+		self.update = update
+		self.stability = stability
+		self.W = None
+		self.H = None
+		self.stats = None
+		self.chunk_size = chunk_size
+		self.forget_factor = forget_factor
+		self.fold_in_iters = fold_in_iters
+
+	def apply( self, X, k = 2, init_W = None, init_H = None ):
+		"""
+		Apply online NMF to the specified document-term matrix X. Only the initial H factor is used from a custom 
+		initialization.
+		"""
+		self.W = None
+		self.H = None
+		self.stats = None
+		random_state = np.random.RandomState( np.random.randint( 1, 100000 ) )
+		start = time.time()
+		n_rows = X.shape[0]
+		chunk_size = max( min( self.chunk_size, n_rows ), 1 )
+		chunks = [( first, min( first + chunk_size, n_rows ) ) for first in range( 0, n_rows, chunk_size )]
+		if not init_H is None:
+			init = "custom"
+			H = np.array( init_H )
+		else:
+			init = self.init_strategy
+			if init == "nndsvd":
+				# initialize the topics from the first chunk
+				H = nndsvd( X[chunks[0][0]:chunks[0][1]], k, random_state = random_state )[1]
+			else:
+				H = np.sqrt( X.mean() / k ) * np.abs( random_state.randn( k, X.shape[1] ) )
+		if self.update == "mu":
+			H[H == 0] = X.mean() / 100
+		H = np.ascontiguousarray( H, dtype = X.dtype )
+		update = update_rules[self.update]
+		# the running statistics W^T W and W^T X are decayed after each chunk, so older chunks have less influence
+		rho = self.forget_factor ** ( float( chunk_size ) / n_rows )
+		A = np.zeros( ( k, k ), dtype = X.dtype )
+		B = np.zeros( ( k, X.shape[1] ), dtype = X.dtype )
+		error_at_init, previous_error, stable, converged = None, None, False, False
+		if not self.stability is None:
+			self.stability.reset()
+		for n_iter in range( 1, self.max_iters + 1 ):
+			error = 0.0
+			for (first, last) in chunks:
+				X_chunk = X[first:last]
+				W_chunk, chunk_error = self.fold_in( X_chunk, H, update, random_state )
+				error += chunk_error
+				A = rho * A + W_chunk.T.dot( W_chunk )
+				B = rho * B + np.asarray( X_chunk.T.dot( W_chunk ) ).T
+				update( H.T, B.T, A )
+			error = np.sqrt( error )
+			decrease = None
+			if error_at_init is None:
+				error_at_init = error
+			elif error_at_init > 0:
+				decrease = ( previous_error - error ) / error_at_init
+				if decrease < self.tol:
+					converged = True
+					break
+			if not self.stability is None and self.stability.check( H, n_iter, decrease ) and n_iter < self.max_iters:
+				stable = True
+				break
+			previous_error = error
+		# recover the document factor for the final topics
+		W = np.zeros( ( n_rows, k ), dtype = X.dtype )
+		error = 0.0
+		for (first, last) in chunks:
+			W[first:last], chunk_error = self.fold_in( X[first:last], H, update, random_state )
+			error += chunk_error
+		self.W, self.H = W, H
+		self.stats = { "engine" : "online-%s" % self.update, "k" : k, "init" : init, "max_iters" : self.max_iters, "tol" : self.tol, 
+			"n_iter" : n_iter, "converged" : converged, "reconstruction_err" : float( np.sqrt( error ) ),
+			"elapsed" : round( time.time() - start, 4 ), "n_rows" : X.shape[0], "n_cols" : X.shape[1], "dtype" : str( X.dtype ),
+			"nnz" : int( X.nnz if scipy.sparse.issparse( X ) else np.count_nonzero( X ) ), "chunk_size" : chunk_size }
+		if not self.stability is None:
+			stopping_stats( self.stats, stable, self.stability )
+
+	def fold_in( self, X_chunk, H, update, random_state ):
+		"""
+		Fold the documents in a chunk into the specified topics, returning their factor W and the squared reconstruction 
+		error of the chunk.
+		"""
+		XHt, HHt = np.asarray( X_chunk.dot( H.T ) ), H.dot( H.T )
+		W = np.asfortranarray( np.maximum( XHt, 0 ) / np.maximum( np.diag( HHt ), 1e-10 ) / H.shape[0], dtype = H.dtype )
+		if self.update == "mu":
+			W[W == 0] = np.sqrt( max( X_chunk.mean(), 1e-10 ) / H.shape[0] )
+		for i in range( self.fold_in_iters ):
+			update( W, XHt, HHt )
+		if scipy.sparse.issparse( X_chunk ):
+			norm_X = np.dot( X_chunk.data, X_chunk.data )
+		else:
+			norm_X = np.sum( X_chunk * X_chunk )
+		error = max( norm_X - 2 * np.sum( W * XHt ) + np.sum( W.T.dot( W ) * HHt ), 0 )
+		return ( W, error )
+
+	def rank_terms( self, topic_index, top = -1 ):
+		"""
+		Return the top ranked terms for the specified topic, generated during the last NMF run.
+		"""
+		if self.H is None:
+			raise ValueError("No results for previous run available")
+		return rank_top_terms( self.H[topic_index:topic_index+1,:], top )[0]
+
+	def rank_all_terms( self, top = -1 ):
+		"""
+		Return the top ranked terms for all topics generated during the last NMF run, as an array with one row per topic.
+		"""
+		if self.H is None:
+			raise ValueError("No results for previous run available")
+		return rank_top_terms( self.H, top )
+
+	def generate_partition( self ):
+		if self.W is None:
+			raise ValueError("No results for previous run available")
+		return np.argmax( self.W, axis = 1 ).flatten().tolist()
+
+# --------------------------------------------------------------
+
+# names of the available NMF engines
+engine_names = ["sklearn", "hals", "mu", "online"]
+
+def create_engine( engine = "sklearn", max_iters = 100, init_strategy = "random", tol = 1e-4, chunk_size = 10000, stability = None ):
+	"""
+	Create an NMF implementation: either the scikit-learn wrapper, the native implementation with HALS or 
+	multiplicative updates, or the online implementation with HALS updates which processes the matrix in chunks of rows.
+	An optional TermStability criterion stops each run once its top terms are stable.
+	"""
+	if engine == "sklearn":
+		return SklNMF( max_iters = max_iters, init_strategy = init_strategy, tol = tol, stability = stability )
+	if engine in ["hals", "mu"]:
+		return NativeNMF( max_iters = max_iters, init_strategy = init_strategy, tol = tol, update = engine, stability = stability )
+	if engine == "online":
+		return OnlineNMF( max_iters = max_iters, init_strategy = init_strategy, tol = tol, chunk_size = chunk_size, stability = stability )
+	raise ValueError( "Unknown NMF engine: %s" % engine )
@@ -90,6 +90,40 @@ class RankingSetAgreement:
 		score /= len(results)
 		return (score, results)
 
+# --------------------------------------------------------------
+# Indexed Rankings
+# --------------------------------------------------------------
+
+class IndexedTermRanking:
+	"""
+	A term ranking stored as an array of indices into a vocabulary, shared with other rankings. The term strings are 
+	only looked up when they are accessed, and slicing the ranking does not copy the vocabulary.
+	"""
+	def __init__( self, indices, terms ):
+		self.indices = indices
+		self.terms = terms
+
+	def __len__( self ):
+		return len(self.indices)
+
+	def __getitem__( self, pos ):
+		if isinstance( pos, slice ):
+			return IndexedTermRanking( self.indices[pos], self.terms )
+		return self.terms[self.indices[pos]]
+
+	def __iter__( self ):
+		for term_index in self.indices:
+			yield self.terms[term_index]
+
+	def __str__( self ):
+		return str( list(self) )
+
+def index_term_rankings( ranking_indices, terms ):
+	"""
+	Create a list of multiple term rankings from an array of ranked term indices, with one row for each ranking.
+	"""
+	return [IndexedTermRanking( indices, terms ) for indices in ranking_indices]
+
 # --------------------------------------------------------------
 # Utilities
 # --------------------------------------------------------------
@@ -1,7 +1,9 @@
+import collections, hashlib, json, os, pickle, struct, zlib
 import numpy as np
 from scipy import sparse as sp
 # note that we use the scikit-learn bundled version of joblib
 from sklearn.externals import joblib
+import unsupervised.rankings
 
 # --------------------------------------------------------------
 
@@ -42,36 +44,193 @@ def clustermap_to_partition( cluster_map, doc_ids ):
 
 def save_term_rankings( out_path, term_rankings, labels = None ):
     """
-    Save a list of multiple term rankings using Joblib.
+    Save a list of multiple term rankings using Joblib. Rankings which are indexed into a vocabulary are stored as an 
+    int32 array of term indices, together with the name of a vocabulary file shared by all rankings in the same directory.
     """
     # no labels? generate some standard ones
     if labels is None:
         labels = []
         for i in range( len(term_rankings) ):
             labels.append( "C%02d" % (i+1) )
-    joblib.dump((term_rankings,labels), out_path ) 
+    if len(term_rankings) > 0 and all( isinstance( ranking, unsupervised.rankings.IndexedTermRanking ) for ranking in term_rankings ):
+        vocab_path = save_vocabulary( os.path.dirname( out_path ), term_rankings[0].terms )
+        ranking_indices = np.array( [ranking.indices for ranking in term_rankings], dtype=np.int32 )
+        joblib.dump((ranking_indices,labels,os.path.basename( vocab_path )), out_path ) 
+    else:
+        joblib.dump((term_rankings,labels), out_path ) 
 
 def load_term_rankings( in_path ):
     """
-    Load a list of multiple term rankings using Joblib.
+    Load a list of multiple term rankings using Joblib. For rankings stored as term indices, the vocabulary is loaded 
+    once and the terms are only looked up when they are accessed.
     """
     #print "Loading term rankings from %s ..." % in_path
-    (term_rankings,labels) = joblib.load( in_path )
+    ranking_set = joblib.load( in_path )
+    if len(ranking_set) == 3:
+        (ranking_indices,labels,vocab_name) = ranking_set
+        terms = load_vocabulary( os.path.join( os.path.dirname( in_path ), vocab_name ) )
+        term_rankings = unsupervised.rankings.index_term_rankings( ranking_indices, terms )
+    else:
+        (term_rankings,labels) = ranking_set
     return (term_rankings,labels)
 
-def save_nmf_factors( out_path, W, H, doc_ids, terms ):
+# vocabularies and lists of document IDs which have already been loaded, by file path
+strings_cache = {}
+
+def save_vocabulary( dir_out, terms ):
+    """
+    Save a list of terms to a vocabulary file in the specified directory, unless it has already been saved. The file
+    is named by a hash of its contents, so that rankings generated from different corpora can share a directory.
+    """
+    digest = hashlib.md5( "\n".join( terms ).encode("utf8") ).hexdigest()
+    vocab_path = os.path.join( dir_out, "vocab_%s.npy" % digest[:16] )
+    if not os.path.exists( vocab_path ):
+        np.save( vocab_path, np.array( terms, dtype=str ) )
+    return vocab_path
+
+def load_vocabulary( in_path ):
+    """
+    Load a list of terms from a vocabulary file, reusing any copy which has already been loaded.
+    """
+    in_path = os.path.abspath( in_path )
+    if not in_path in strings_cache:
+        strings_cache[in_path] = np.load( in_path ).tolist()
+    return strings_cache[in_path]
+
+def save_doc_ids( dir_out, doc_ids ):
+    """
+    Save a list of document IDs to a file in the specified directory, unless it has already been saved. The IDs are 
+    stored as UTF-8 bytes with offsets, rather than as a fixed-width array, and the file is named by a hash of its 
+    contents, so that all models generated from the same documents share it.
+    """
+    digest = hashlib.md5( "\n".join( doc_ids ).encode("utf8") ).hexdigest()
+    docs_path = os.path.join( dir_out, "docs_%s.npz" % digest[:16] )
+    if not os.path.exists( docs_path ):
+        encoded = [doc_id.encode("utf8") for doc_id in doc_ids]
+        offsets = np.cumsum( [0] + [len(x) for x in encoded] )
+        np.savez( docs_path, data = np.frombuffer( b"".join( encoded ), dtype=np.uint8 ), offsets = offsets )
+    return docs_path
+
+def load_doc_ids( in_path ):
+    """
+    Load a list of document IDs from a file written by save_doc_ids(), reusing any copy which has already been loaded.
+    """
+    in_path = os.path.abspath( in_path )
+    if not in_path in strings_cache:
+        with np.load( in_path ) as container:
+            data, offsets = container["data"].tobytes(), container["offsets"]
+        strings_cache[in_path] = [data[offsets[i]:offsets[i+1]].decode("utf8") for i in range( len(offsets) - 1 )]
+    return strings_cache[in_path]
+
+def save_nmf_factors( out_path, W, H, doc_ids, terms, top = None, quantize = False, compress = False ):
+    """
+    Save a NMF factorization result using Joblib. If the output path has the extension .npz, the factors are
+    stored as separate arrays in a NumPy container, so that each one can be loaded on its own, while the document IDs
+    and terms are stored once in the same directory and referred to by file name. For .npz containers, a compact format 
+    can be used: if top is specified, only the top entries for each topic in W and H are kept; if quantize is True, the 
+    values are scaled and stored as float16; if compress is True, the container is compressed.
+    """
+    if not out_path.endswith(".npz"):
+        joblib.dump((W,H,doc_ids,terms), out_path ) 
+        return
+    dir_out = os.path.dirname( out_path )
+    arrays = factor_arrays( W, H, top, quantize )
+    arrays["doc_ids_file"] = np.array( os.path.basename( save_doc_ids( dir_out, doc_ids ) ) )
+    arrays["terms_file"] = np.array( os.path.basename( save_vocabulary( dir_out, terms ) ) )
+    if compress:
+        np.savez_compressed( out_path, **arrays )
+    else:
+        np.savez( out_path, **arrays )
+
+def factor_arrays( W, H, top = None, quantize = False ):
+    """
+    Convert the W and H factors to a dictionary of named arrays, using the compact factor format if required.
+    """
+    if top is None and not quantize:
+        return { "W" : W, "H" : H }
+    # NB: both factors are stored with one row per topic
+    arrays = {}
+    for name, F in [ ("W", np.asarray(W).T), ("H", np.asarray(H)) ]:
+        arrays.update( compact_factor( name, F, top, quantize ) )
+    return arrays
+
+def factor_from_arrays( arrays, name ):
+    """
+    Return the specified factor (W or H) from a dictionary or container of named arrays, expanding it to a dense array
+    if it is stored in the compact factor format.
+    """
+    if not "%s_values" % name in arrays:
+        return arrays[name]
+    F = expand_factor( arrays, name )
+    if name == "W":
+        return np.ascontiguousarray( F.T )
+    return F
+
+def compact_factor( name, F, top = None, quantize = False ):
     """
-    Save a NMF factorization result using Joblib.
+    Convert a factor matrix with one row per topic to the arrays used by the compact factor format, keeping only the 
+    top entries in each row if specified, and quantizing the values to float16 relative to the maximum of each row.
     """
-    joblib.dump((W,H,doc_ids,terms), out_path ) 
+    arrays = { "%s_shape" % name : np.array( F.shape ) }
+    if top is None or top >= F.shape[1]:
+        values = F
+    else:
+        indices = np.argpartition( -F, top - 1, axis = 1 )[:,:top]
+        values = np.take_along_axis( F, indices, axis = 1 )
+        arrays["%s_indices" % name] = indices.astype( np.int32 )
+    if quantize:
+        scale = values.max( axis = 1, keepdims = True ).astype( np.float32 )
+        scale[scale <= 0] = 1
+        arrays["%s_scale" % name] = scale
+        values = ( values / scale ).astype( np.float16 )
+    arrays["%s_values" % name] = values
+    return arrays
+
+def expand_factor( container, name ):
+    """
+    Convert the arrays of a factor stored in the compact factor format back to a dense matrix with one row per topic.
+    """
+    values = container["%s_values" % name]
+    if "%s_scale" % name in container:
+        values = values.astype( np.float32 ) * container["%s_scale" % name]
+    if not "%s_indices" % name in container:
+        return values
+    F = np.zeros( tuple( container["%s_shape" % name] ), dtype = values.dtype )
+    np.put_along_axis( F, container["%s_indices" % name], values, axis = 1 )
+    return F
 
 def load_nmf_factors( in_path ):
     """
     Load a NMF factorization result using Joblib.
     """
-    (W,H,doc_ids,terms) = joblib.load( in_path )
+    (W,H,doc_ids,terms) = load_nmf_fields( in_path, ["W","H","doc_ids","terms"] )
     return (W,H,doc_ids,terms)
 
+def load_nmf_fields( in_path, fields ):
+    """
+    Load only the specified fields (any of W, H, doc_ids and terms) of a NMF factorization result, returned as a tuple
+    in the same order. For factors stored in a .npz container, the remaining fields are not read. Factors stored in
+    the compact format are returned as dense arrays, with zeros for the entries which were not kept.
+    """
+    if in_path.endswith(".npz"):
+        values = []
+        dir_in = os.path.dirname( in_path )
+        with np.load( in_path ) as container:
+            for field in fields:
+                if field in ["doc_ids","terms"] and field in container:
+                    # NB: older containers store the document IDs and terms as arrays
+                    values.append( container[field].tolist() )
+                elif field == "doc_ids":
+                    values.append( load_doc_ids( os.path.join( dir_in, str( container["doc_ids_file"] ) ) ) )
+                elif field == "terms":
+                    values.append( load_vocabulary( os.path.join( dir_in, str( container["terms_file"] ) ) ) )
+                else:
+                    values.append( factor_from_arrays( container, field ) )
+        return tuple(values)
+    (W,H,doc_ids,terms) = joblib.load( in_path )
+    all_values = { "W" : W, "H" : H, "doc_ids" : doc_ids, "terms" : terms }
+    return tuple( [all_values[field] for field in fields] )
+
 def save_partition( out_path, partition, doc_ids ):
     """
     Save a disjoint partition (clustering) result using Joblib.
@@ -100,6 +259,330 @@ def load_lda_doc_weights( in_path):
         return(W)
 
 
+def parse_k_range( spec ):
+    """
+    Parse a number of topics, or a range of numbers of topics in the form start:end or start:end:step, where the end
+    is included in the range.
+    """
+    parts = [int( part ) for part in str( spec ).split(":")]
+    if len(parts) == 1:
+        return parts
+    if len(parts) > 3 or parts[0] > parts[1] or ( len(parts) == 3 and parts[2] < 1 ):
+        raise ValueError( "Invalid range for number of topics: %s" % spec )
+    step = 1 if len(parts) == 2 else parts[2]
+    return list( range( parts[0], parts[1] + 1, step ) )
+
+# --------------------------------------------------------------
+# Ensemble Archive
+# --------------------------------------------------------------
+
+# file extension used for ensemble archives, and the marker at the start and end of each archive
+archive_extension = ".ens"
+archive_magic = b"ENSARCH1"
+
+def is_ensemble_archive( in_path ):
+    """
+    Check whether the specified path is an ensemble archive file.
+    """
+    if not os.path.isfile( in_path ):
+        return False
+    with open( in_path, "rb" ) as fin:
+        return fin.read( len(archive_magic) ) == archive_magic
+
+class EnsembleArchive:
+    """
+    A single file containing the term rankings, partitions and factors of the members of an ensemble. Members are appended
+    one at a time. Each field of a member is stored as a separate record, and an index of the records is stored at the end 
+    of the file. The document IDs and terms are stored once, and shared by all members which use them.
+    """
+    def __init__( self, path ):
+        self.path = path
+        self.index = []
+        self.index_offset = len(archive_magic)
+        if os.path.exists( path ):
+            with open( path, "rb" ) as fin:
+                self.read_index( fin )
+
+    def read_index( self, fin ):
+        if fin.read( len(archive_magic) ) != archive_magic:
+            raise ValueError( "Not an ensemble archive: %s" % self.path )
+        fin.seek( -8 - len(archive_magic), os.SEEK_END )
+        end = fin.tell()
+        self.index_offset = struct.unpack( "<Q", fin.read(8) )[0]
+        if fin.read( len(archive_magic) ) != archive_magic:
+            raise ValueError( "Incomplete ensemble archive: %s" % self.path )
+        fin.seek( self.index_offset )
+        self.index = pickle.loads( fin.read( end - self.index_offset ) )
+
+    def member_names( self ):
+        """
+        Return the names of the members in the archive, in the order in which they were appended.
+        """
+        return [entry["member"] for entry in self.index if entry["kind"] == "ranks"]
+
+    def member_meta( self ):
+        """
+        Return the metadata (e.g. k, seed and run) of each member in the archive, as read from the index.
+        """
+        return collections.OrderedDict( (entry["member"], entry["meta"]) for entry in self.index if entry["kind"] == "ranks" )
+
+    def append( self, name, W, H, doc_ids, terms, partition, term_rankings, labels = None, meta = None, top = None, quantize = False, compress = False ):
+        """
+        Append a new ensemble member to the archive. The term rankings can be a list of rankings indexed into the terms,
+        or an array of ranked term indices with one row per topic. The factors are stored in the compact factor format 
+        if top or quantize are specified, and the factors record is compressed if compress is True. Returns a checksum 
+        of the member's records, which does not depend on whether they are compressed.
+        """
+        if meta is None:
+            meta = {}
+        meta = dict( meta, k = H.shape[0], n_docs = len(doc_ids) )
+        if len(term_rankings) > 0 and isinstance( term_rankings[0], unsupervised.rankings.IndexedTermRanking ):
+            term_rankings = [ranking.indices for ranking in term_rankings]
+        records = []
+        doc_ids_key = self.strings_record( doc_ids, records )
+        terms_key = self.strings_record( terms, records )
+        records.append( ( { "member" : name, "kind" : "ranks", "meta" : meta }, 
+            ( np.array( term_rankings, dtype=np.int32 ), labels, terms_key ) ) )
+        records.append( ( { "member" : name, "kind" : "partition", "meta" : meta }, ( np.array( partition, dtype=np.int32 ), doc_ids_key ) ) )
+        records.append( ( { "member" : name, "kind" : "factors", "meta" : meta, "compressed" : compress }, ( factor_arrays( W, H, top, quantize ), doc_ids_key, terms_key ) ) )
+        # overwrite the old index with the new records, then write the updated index
+        mode = "r+b" if os.path.exists( self.path ) else "wb"
+        with open( self.path, mode ) as fout:
+            if mode == "wb":
+                fout.write( archive_magic )
+            fout.seek( self.index_offset )
+            fout.truncate()
+            checksum = hashlib.md5()
+            for (entry, value) in records:
+                data = pickle.dumps( value, protocol = pickle.HIGHEST_PROTOCOL )
+                if entry["kind"] != "strings":
+                    checksum.update( data )
+                if entry.get("compressed"):
+                    data = zlib.compress( data )
+                entry["offset"] = fout.tell()
+                entry["length"] = len(data)
+                fout.write( data )
+                self.index.append( entry )
+            self.index_offset = fout.tell()
+            fout.write( pickle.dumps( self.index, protocol = pickle.HIGHEST_PROTOCOL ) )
+            fout.write( struct.pack( "<Q", self.index_offset ) )
+            fout.write( archive_magic )
+        return checksum.hexdigest()
+
+    def strings_record( self, strings, records ):
+        """
+        Add a record for a list of strings to the specified list of new records, unless it is already stored. Returns the 
+        key used to refer to the list.
+        """
+        key = hashlib.md5( "\n".join( strings ).encode("utf8") ).hexdigest()
+        for (entry, value) in records:
+            if entry.get("key") == key:
+                return key
+        for entry in self.index:
+            if entry.get("key") == key:
+                return key
+        records.append( ( { "member" : None, "kind" : "strings", "key" : key }, list(strings) ) )
+        return key
+
+    def read_record( self, entry, data ):
+        """
+        Unpickle the stored data of a record, decompressing it first if necessary.
+        """
+        if entry.get("compressed"):
+            data = zlib.decompress( data )
+        return pickle.loads( data )
+
+    def load_members( self, fields = ["ranks", "partition", "factors"], names = None ):
+        """
+        Load the specified fields (any of ranks, partition and factors) for all members of the archive, or only the members
+        with the specified names, returned as a list of dictionaries in the order in which the members were appended. If all 
+        fields are required, the archive is read in a single sequential pass; otherwise only the required records are read, 
+        in the order in which they are stored.
+        """
+        if names is None:
+            entries = [entry for entry in self.index if entry["kind"] in fields or entry["kind"] == "strings"]
+        else:
+            names = set( names )
+            entries = [entry for entry in self.index if ( entry["kind"] in fields and entry["member"] in names ) or entry["kind"] == "strings"]
+        values = []
+        with open( self.path, "rb" ) as fin:
+            if len(entries) == len(self.index):
+                data = fin.read( self.index_offset )
+                for entry in entries:
+                    values.append( self.read_record( entry, data[entry["offset"]:entry["offset"]+entry["length"]] ) )
+            else:
+                for entry in entries:
+                    fin.seek( entry["offset"] )
+                    values.append( self.read_record( entry, fin.read( entry["length"] ) ) )
+        # build the members from their records
+        strings = {}
+        for entry, value in zip( entries, values ):
+            if entry["kind"] == "strings":
+                strings[entry["key"]] = value
+        members = collections.OrderedDict()
+        for entry, value in zip( entries, values ):
+            if entry["kind"] == "strings":
+                continue
+            member = members.setdefault( entry["member"], { "name" : entry["member"], "meta" : entry["meta"] } )
+            if entry["kind"] == "ranks":
+                (ranking_indices, labels, terms_key) = value
+                member["term_rankings"] = unsupervised.rankings.index_term_rankings( ranking_indices, strings[terms_key] )
+                member["labels"] = labels
+            elif entry["kind"] == "partition":
+                (partition, doc_ids_key) = value
+                member["partition"] = partition.tolist()
+                member["doc_ids"] = strings[doc_ids_key]
+            elif entry["kind"] == "factors":
+                (arrays, doc_ids_key, terms_key) = value
+                member["W"] = factor_from_arrays( arrays, "W" )
+                member["H"] = factor_from_arrays( arrays, "H" )
+                member["doc_ids"] = strings[doc_ids_key]
+                member["terms"] = strings[terms_key]
+        return list( members.values() )
+
+# --------------------------------------------------------------
+# Ensemble Manifest
+# --------------------------------------------------------------
+
+# name of the file in each output directory which lists the models stored in that directory
+manifest_filename = "manifest.jsonl"
+
+def file_checksum( in_path, block_size = 1 << 20 ):
+    """
+    Calculate the MD5 checksum of the contents of the specified file.
+    """
+    checksum = hashlib.md5()
+    with open( in_path, "rb" ) as fin:
+        for block in iter( lambda: fin.read( block_size ), b"" ):
+            checksum.update( block )
+    return checksum.hexdigest()
+
+def append_manifest( dir_out, model, meta, files = None, archive_path = None, checksum = None ):
+    """
+    Add an entry for a model to the manifest in the specified output directory. The model is either stored as the 
+    specified dictionary of files (e.g. ranks, partition and factors), or as a member of an ensemble archive. The paths 
+    are stored relative to the output directory. If no checksum is given, it is calculated from the contents of the files.
+    """
+    entry = collections.OrderedDict( model = model )
+    entry.update( meta )
+    if not files is None:
+        entry["files"] = collections.OrderedDict( (kind, os.path.relpath( path, dir_out )) for kind, path in files.items() )
+        if checksum is None:
+            checksum = hashlib.md5( "".join( file_checksum( path ) for path in files.values() ).encode("ascii") ).hexdigest()
+    if not archive_path is None:
+        entry["archive"] = os.path.relpath( archive_path, dir_out )
+    entry["checksum"] = checksum
+    with open( os.path.join( dir_out, manifest_filename ), "a" ) as fout:
+        fout.write( json.dumps( entry ) + "\n" )
+
+# name of the file in each output directory which logs the diagnostics of each NMF run
+run_log_filename = "runs.jsonl"
+
+def append_run_log( dir_out, model, stats ):
+    """
+    Add the diagnostics of an NMF run (e.g. iterations, reconstruction error and elapsed time) to the run log in the 
+    specified output directory.
+    """
+    entry = collections.OrderedDict( model = model )
+    entry.update( sorted( stats.items() ) )
+    with open( os.path.join( dir_out, run_log_filename ), "a" ) as fout:
+        fout.write( json.dumps( entry ) + "\n" )
+
+def load_manifest( dir_path ):
+    """
+    Load the entries of the manifest in the specified directory, or an empty list if there is no manifest. Where the same 
+    model has been written more than once, only the latest entry is kept.
+    """
+    manifest_path = os.path.join( dir_path, manifest_filename )
+    if not os.path.exists( manifest_path ):
+        return []
+    entries = collections.OrderedDict()
+    with open( manifest_path, "r" ) as fin:
+        for line in fin:
+            if len(line.strip()) > 0:
+                entry = json.loads( line )
+                key = ( entry.get("archive"), entry["model"] )
+                entries.pop( key, None )
+                entries[key] = entry
+    return list( entries.values() )
+
+def parse_selection( spec ):
+    """
+    Parse a selection of models such as "k=10,run=3" into a dictionary mapping each field to its set of allowed values.
+    Repeating a field allows several values, e.g. "run=1,run=2".
+    """
+    selection = {}
+    for condition in spec.split(","):
+        parts = condition.split("=")
+        if len(parts) != 2:
+            raise ValueError( "Invalid model selection: %s" % condition )
+        selection.setdefault( parts[0].strip(), set() ).add( parts[1].strip() )
+    return selection
+
+def matches_selection( meta, selection ):
+    """
+    Check whether the metadata of a model satisfies every field of a selection.
+    """
+    for field, values in selection.items():
+        if not str( meta.get( field ) ) in values:
+            return False
+    return True
+
+def find_models( paths, kind, selection = None ):
+    """
+    Find the stored models which have the specified kind of output (e.g. ranks or partition) in a list of files, 
+    directories and ensemble archives. For directories with a manifest, the models are listed from the manifest rather 
+    than by matching file names. If a selection is specified, only models whose manifest or archive metadata match it 
+    are kept. Returns a sorted list of file paths, and a dictionary mapping each archive path to its selected members.
+    Raises an IOError if any of the paths does not exist.
+    """
+    for path in paths:
+        if not os.path.exists( path ):
+            raise IOError( "No such file or directory: %s" % path )
+    file_paths, archive_members, selected_files = [], collections.OrderedDict(), {}
+    def add_archive( archive_path, names = None ):
+        if names is None:
+            names = [name for name, meta in EnsembleArchive( archive_path ).member_meta().items() 
+                if selection is None or matches_selection( meta, selection )]
+        if len(names) > 0:
+            archive_members.setdefault( archive_path, [] ).extend( names )
+    def manifest_models( dir_path ):
+        for entry in load_manifest( dir_path ):
+            if not ( selection is None or matches_selection( entry, selection ) ):
+                continue
+            if "archive" in entry:
+                yield ( os.path.join( dir_path, entry["archive"] ), entry["model"] )
+            elif kind in entry["files"]:
+                yield ( os.path.join( dir_path, entry["files"][kind] ), None )
+    for path in paths:
+        if os.path.isdir( path ):
+            for dir_path, dirs, files in os.walk( path ):
+                if manifest_filename in files:
+                    for (model_path, name) in manifest_models( dir_path ):
+                        if name is None:
+                            file_paths.append( model_path )
+                        else:
+                            add_archive( model_path, [name] )
+                    continue
+                for fname in files:
+                    if fname.endswith( archive_extension ):
+                        add_archive( os.path.join( dir_path, fname ) )
+                    elif selection is None and fname.startswith( kind ) and fname.endswith( ".pkl" ):
+                        file_paths.append( os.path.join( dir_path, fname ) )
+        elif is_ensemble_archive( path ):
+            add_archive( path )
+        elif selection is None:
+            file_paths.append( path )
+        else:
+            # look up the metadata for the file in the manifest of its directory
+            dir_path = os.path.dirname( path )
+            if not dir_path in selected_files:
+                selected_files[dir_path] = set( os.path.normpath( model_path ) for (model_path, name) in manifest_models( dir_path ) )
+            if os.path.normpath( path ) in selected_files[dir_path]:
+                file_paths.append( path )
+    file_paths.sort()
+    return ( file_paths, archive_members )
+
 # --------------------------------------------------------------
 
 def write_table( out_path, tab, delimiter = ',' ):